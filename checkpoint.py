@@ -0,0 +1,136 @@
+import csv
+import datetime
+import gzip
+import io
+import json
+import os
+import shutil
+import zlib
+from pathlib import Path
+
+
+class Checkpoint:
+    """Append-only journal of input files already committed to the outputs
+
+    Each line is a JSON object with the input file (`arquivo`), the size of
+    every output file right after its chunk was committed (so a resumed run
+    can truncate the outputs back to a consistent state) and the commit time
+    (`parseado_em`).
+    """
+
+    def __init__(self, filename):
+        self.filename = Path(filename)
+        self.fobj = None
+
+    def entries(self):
+        """Yield (entry, journal size up to its end) for each complete line"""
+
+        if not self.filename.exists():
+            return
+
+        size = 0
+        with open(self.filename, mode="rb") as fobj:
+            for line in fobj:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError()
+                    entry = json.loads(line)
+                except ValueError:  # Incomplete last line (crash while writing)
+                    return
+                size += len(line)
+                yield entry, size
+
+    def load(self):
+        """Return (committed files, output sizes of the last commit)"""
+
+        done, sizes = set(), {}
+        for entry, _ in self.entries():
+            done.add(entry["arquivo"])
+            sizes = entry["sizes"]
+        return done, sizes
+
+    def open(self, resume=False):
+        if resume and self.filename.exists():
+            # Drop an incomplete last line, so new entries start on a new one
+            size = 0
+            for _, size in self.entries():
+                pass
+            os.truncate(self.filename, size)
+        self.fobj = open(self.filename, mode="a" if resume else "w", encoding="utf-8")
+
+    def commit(self, arquivo, sizes):
+        """Record `arquivo` as committed and return the commit time"""
+
+        parseado_em = datetime.datetime.now().isoformat()
+        entry = {"arquivo": arquivo, "sizes": sizes, "parseado_em": parseado_em}
+        self.fobj.write(json.dumps(entry) + "\n")
+        self.fobj.flush()
+        os.fsync(self.fobj.fileno())
+        return parseado_em
+
+    def close(self):
+        if self.fobj is not None:
+            self.fobj.close()
+            self.fobj = None
+
+
+class ChunkedCSVWriter:
+    """Write a gzipped CSV as a sequence of independent gzip members
+
+    Rows are buffered in memory and only reach the disk on `commit`, as one
+    complete gzip member (concatenated members are a valid gzip stream), so
+    the file can always be truncated back to the end of the last commit.
+    """
+
+    def __init__(self, filename, fieldnames, resume_size=None):
+        self.filename = Path(filename)
+        self.fieldnames = fieldnames
+        self.buffer = io.StringIO()
+        self.writer = csv.DictWriter(self.buffer, fieldnames=fieldnames)
+        if resume_size is None:
+            self.fobj = open(self.filename, mode="wb")
+            self.writer.writeheader()
+            self.commit()
+        else:
+            self.fobj = open(self.filename, mode="r+b")
+            self.fobj.truncate(resume_size)
+            self.fobj.seek(resume_size)
+
+    def writerows(self, data):
+        self.writer.writerows(data)
+
+    def commit(self):
+        """Flush buffered rows to disk and return the resulting file size"""
+
+        data = self.buffer.getvalue()
+        if data:
+            self.fobj.write(gzip.compress(data.encode("utf-8")))
+            self.buffer.seek(0)
+            self.buffer.truncate()
+        self.fobj.flush()
+        os.fsync(self.fobj.fileno())
+        return self.fobj.tell()
+
+    def close(self):
+        self.commit()
+        self.fobj.close()
+
+
+def concatenate_chunked(filenames, filename):
+    """Concatenate `ChunkedCSVWriter` files (with the same header) into one
+
+    Compressed members are copied as they are; only the first file's header
+    is kept. `filename` is replaced atomically.
+    """
+
+    temp_filename = Path(filename).with_name(Path(filename).name + ".tmp")
+    with open(temp_filename, mode="wb") as fobj:
+        for index, source_filename in enumerate(filenames):
+            with open(source_filename, mode="rb") as source:
+                if index > 0:
+                    # The header is always the first member, written alone
+                    decompressor = zlib.decompressobj(wbits=31)
+                    decompressor.decompress(source.read(64 * 1024))
+                    fobj.write(decompressor.unused_data)
+                shutil.copyfileobj(source, fobj)
+    os.replace(temp_filename, filename)
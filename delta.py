@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""Generate the changes (per sheet) of the outputs since the last run
+
+Rows are identified by (tribunal, ano_de_referencia, mes_de_referencia, cpf,
+nome, ordem), where `ordem` numbers the rows repeating the other values. Only
+each row's key values plus short hashes of its key (`chave`, see `key_hash`)
+and values are kept between runs (in `settings.DELTA_STATE_DB`), so removed
+rows have only the key columns filled.
+"""
+
+import csv
+import datetime
+import gzip
+import hashlib
+import os
+import sqlite3
+from collections import Counter
+from pathlib import Path
+
+import settings
+
+
+KEY_FIELDS = ["tribunal", "ano_de_referencia", "mes_de_referencia", "cpf", "nome"]
+OPERATION_FIELDS = ["operacao", "chave", "ordem"]
+INSERT, UPDATE, DELETE = "inclusao", "alteracao", "exclusao"
+
+
+def row_hash(values):
+    return hashlib.blake2b("\x1f".join(values).encode("utf-8"), digest_size=8).digest()
+
+
+def key_hash(key_values, ordinal):
+    """Hash of a row's `KEY_FIELDS` values (as in the CSV) and `ordem`"""
+
+    return row_hash(list(key_values) + [str(ordinal)])
+
+
+class DeltaState:
+    """Row hashes and key values of the last run's outputs, by sheet and row key
+
+    Key values (`chave_texto`) are the row's `KEY_FIELDS` values and `ordem`
+    joined by "\x1f".
+    """
+
+    def __init__(self, filename=settings.DELTA_STATE_DB):
+        self.filename = Path(filename)
+        self.connection = sqlite3.connect(str(self.filename))
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS planilha (
+                nome TEXT PRIMARY KEY,
+                atualizada_em TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS linha (
+                planilha TEXT NOT NULL,
+                chave BLOB NOT NULL,
+                hash BLOB NOT NULL,
+                chave_texto TEXT,
+                PRIMARY KEY (planilha, chave)
+            ) WITHOUT ROWID;
+            """
+        )
+        # States saved before key values were kept (their removed rows will
+        # have only `chave`)
+        columns = [
+            row[1] for row in self.connection.execute("PRAGMA table_info(linha)")
+        ]
+        if "chave_texto" not in columns:
+            self.connection.execute("ALTER TABLE linha ADD COLUMN chave_texto TEXT")
+
+    def hashes(self, sheet):
+        """Return the sheet's {chave: (hash, chave_texto)} or `None` if no state"""
+
+        saved = self.connection.execute(
+            "SELECT 1 FROM planilha WHERE nome = ?", (sheet,)
+        ).fetchone()
+        if saved is None:
+            return None
+        return {
+            key: (value, key_text)
+            for key, value, key_text in self.connection.execute(
+                "SELECT chave, hash, chave_texto FROM linha WHERE planilha = ?",
+                (sheet,),
+            )
+        }
+
+    def replace(self, sheet, hashes):
+        """Replace a sheet's state by `hashes` (like `hashes().items()`)"""
+
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO planilha (nome, atualizada_em) VALUES (?, ?)",
+                (sheet, datetime.datetime.now().isoformat()),
+            )
+            self.connection.execute("DELETE FROM linha WHERE planilha = ?", (sheet,))
+            self.connection.executemany(
+                """
+                INSERT INTO linha (planilha, chave, hash, chave_texto)
+                VALUES (?, ?, ?, ?)
+                """,
+                ((sheet, key, value, key_text) for key, (value, key_text) in hashes),
+            )
+
+    def close(self):
+        self.connection.close()
+
+
+def sheet_delta(filename, delta_filename, previous):
+    """Compare an output file to the `previous` hashes and write the changes
+
+    Return the new hashes (a dict, like `DeltaState.hashes`) and the number of
+    rows by operation. If there's no previous state (`None`, first run),
+    nothing is written. Removed rows have only the key columns filled.
+    """
+
+    hashes, counts, ordinals = {}, Counter(), Counter()
+    baseline = previous is None
+    with gzip.open(filename, mode="rt", encoding="utf-8", newline="") as fobj:
+        reader = csv.reader(fobj)
+        header = next(reader)
+        key_indexes = [header.index(field_name) for field_name in KEY_FIELDS]
+        if not baseline:
+            temp_filename = delta_filename.with_name(delta_filename.name + ".tmp")
+            output = gzip.open(temp_filename, mode="wt", encoding="utf-8", newline="")
+            writer = csv.writer(output)
+            writer.writerow(OPERATION_FIELDS + header)
+
+        for values in reader:
+            key_values = [values[index] for index in key_indexes]
+            prefix = row_hash(key_values)
+            ordinals[prefix] += 1
+            ordinal = ordinals[prefix]
+            key = key_hash(key_values, ordinal)
+            value = row_hash(values)
+            hashes[key] = (value, "\x1f".join(key_values + [str(ordinal)]))
+            if baseline:
+                continue
+            old_value, _ = previous.pop(key, (None, None))
+            if old_value == value:
+                continue
+            operation = INSERT if old_value is None else UPDATE
+            writer.writerow([operation, key.hex(), ordinal] + values)
+            counts[operation] += 1
+
+    if not baseline:
+        # Keys left in `previous` are not in the current output anymore
+        for key, (_, key_text) in previous.items():
+            values, ordinal = [""] * len(header), ""
+            if key_text is not None:
+                *key_values, ordinal = key_text.split("\x1f")
+                for index, key_value in zip(key_indexes, key_values):
+                    values[index] = key_value
+            writer.writerow([DELETE, key.hex(), ordinal] + values)
+            counts[DELETE] += 1
+        output.close()
+        os.replace(temp_filename, delta_filename)
+    return hashes, counts
+
+
+def generate_deltas(filenames, run_id=None):
+    """Write the changes in each output file to `DELTA_PATH/<run_id>/`
+
+    Return the number of changed rows by output filename and operation.
+    """
+
+    run_id = run_id or datetime.datetime.now().strftime("%Y%m%dT%H%M%S")
+    delta_path = settings.DELTA_PATH / run_id
+    state = DeltaState()
+    result = {}
+    for filename in filenames:
+        if not filename.exists():
+            continue
+        if not delta_path.exists():
+            delta_path.mkdir(parents=True)
+        sheet = filename.name.split(".")[0]
+        hashes, counts = sheet_delta(
+            filename, delta_path / filename.name, state.hashes(sheet)
+        )
+        # The state is only updated after the delta file is complete, so an
+        # interrupted run produces the same changes again on the next one
+        state.replace(sheet, hashes.items())
+        result[filename.name] = counts
+    state.close()
+    return result
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from parse_files import SHEET_INFO
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--run-id", help="Name of the directory (inside data/output/delta)"
+    )
+    args = parser.parse_args()
+
+    filenames = [info["output_filename"] for info in SHEET_INFO.values()]
+    for name, counts in generate_deltas(filenames, args.run_id).items():
+        print(name, dict(counts))
@@ -8,6 +8,7 @@ import rows
 import scrapy
 from rows.utils import slug
 
+import pipelined
 import settings
 import utils
 from utils import fix_tribunal
@@ -22,6 +23,12 @@ class SalariosMagistradosSpider(scrapy.Spider):
     month_url = "http://www.cnj.jus.br/transparencia/remuneracao-dos-magistrados/remuneracao-{month_slug}-{year}"
     name = "salarios-magistrados"
     start_urls = ["http://www.cnj.jus.br/transparencia/remuneracao-dos-magistrados"]
+    # `pipelined` (imported above) also imports `store`, so both are importable
+    # by scrapy
+    custom_settings = {
+        "EXTENSIONS": {"pipelined.ParseWhileDownloading": 500},
+        "ITEM_PIPELINES": {"store.PlanilhaPipeline": 300},
+    }
 
     def make_month_request(self, year, month, force_url=None):
         if force_url is None:
@@ -133,3 +140,8 @@ class SalariosMagistradosSpider(scrapy.Spider):
             filename.parent.mkdir(parents=True)
         with open(filename, mode="wb") as fobj:
             fobj.write(response.body)
+        self.crawler.signals.send_catch_log(
+            signal=pipelined.file_saved,
+            row=response.request.meta["row"],
+            body=response.body,
+        )
@@ -0,0 +1,75 @@
+from itertools import islice
+
+
+# Metadata block and header lines are usually near the top of the sheets
+LAYOUT_PROBE_ROWS = 50
+
+
+def merge_header_lines(first, second):
+    result = []
+    for value1, value2 in zip(first, second):
+        if value1 is None and value2 is None:
+            result.append(None)
+        elif value1 is None:
+            result.append(value2)
+        elif value2 is None:
+            result.append(value1)
+        else:
+            result.append(f"{value1} {value2}")
+    return result
+
+
+def find_layout(head):
+    """Find metadata block, header lines and data start on a sheet's first rows"""
+
+    header, header_row, start_row = [], None, None
+    for index, row in enumerate(head):
+        if "CPF" in row or "Nome" in row:  # First header line
+            header.append(row)
+            header_row = index
+        elif len(header) == 1:
+            if (
+                row[0] in (None, "")
+                and set(type(value) for value in row).issubset({type(None), str})
+                and any(
+                    "total" in (value or "").lower() or "outra" in (value or "").lower()
+                    for value in row
+                )
+            ):
+                # Second header line
+                header.append(row)
+                start_row = index + 1
+            else:
+                # Data starts in this row
+                start_row = index
+            break
+    if not header:
+        return {"metadata": head, "header": None, "start_row": None}
+    elif len(header) > 1:
+        header = merge_header_lines(*header)
+    else:
+        header = header[0]
+        if start_row is None:
+            start_row = header_row + 1
+
+    return {"metadata": head[:header_row], "header": header, "start_row": start_row}
+
+
+def probe_layout(rows, probe_rows=LAYOUT_PROBE_ROWS):
+    """Find the layout reading only the first `probe_rows` rows, if possible
+
+    The whole sheet is read if the header is not found on these rows or if
+    it's on the last one (a second header line could come next). Return the
+    layout and whether the whole sheet was read.
+    """
+
+    rows = iter(rows)
+    head = list(islice(rows, probe_rows))
+    layout = find_layout(head)
+    if len(head) < probe_rows or (
+        layout["header"] is not None and layout["start_row"] < len(head)
+    ):
+        return layout, False
+
+    head.extend(rows)
+    return find_layout(head), True
@@ -0,0 +1,101 @@
+import csv
+import json
+import logging
+import logging.handlers
+import multiprocessing
+from collections import Counter
+
+
+EVENT_FIELDS = ("file", "sheet", "field", "value", "expected")
+logger = logging.getLogger("parser")
+context = {}
+
+
+def set_context(**kwargs):
+    """Define fields added to all next events from this process (file, sheet)"""
+
+    context.clear()
+    context.update(kwargs)
+
+
+def event(level, code, **fields):
+    """Log a structured event, identified by `code`
+
+    Nothing is built if `level` is disabled and values are only converted to
+    text by the listener (outside the parsing hot path).
+    """
+
+    if logger.isEnabledFor(level):
+        data = context.copy()
+        data.update(fields)
+        logger.log(level, code, extra={"event": data})
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        data = {"level": record.levelname, "code": record.getMessage()}
+        event = getattr(record, "event", {})
+        for key in EVENT_FIELDS:
+            data[key] = event.get(key)
+        for key in ("value", "expected"):
+            if data[key] is not None:
+                data[key] = repr(data[key])
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class SummaryHandler(logging.Handler):
+    """Count events by level and code"""
+
+    def __init__(self):
+        super().__init__()
+        self.counter = Counter()
+
+    def emit(self, record):
+        self.counter[(record.levelname, record.getMessage())] += 1
+
+    def save(self, filename):
+        with open(filename, mode="w", encoding="utf-8") as fobj:
+            writer = csv.writer(fobj)
+            writer.writerow(["level", "code", "count"])
+            for (level, code), count in self.counter.most_common():
+                writer.writerow([level, code, count])
+
+
+class EventLog:
+    """Send events through a queue to a buffered file plus a run summary
+
+    The queue can be shared with worker processes (see `configure_worker`),
+    so only the listener (in the main process) writes to the log files.
+    """
+
+    def __init__(self, filename, summary_filename, capacity=10000):
+        self.summary_filename = summary_filename
+        self.queue = multiprocessing.Queue(-1)
+        self.file_handler = logging.FileHandler(filename, mode="w", encoding="utf-8")
+        self.file_handler.setFormatter(JSONFormatter())
+        # Errors are written right away (they may precede a crash)
+        self.buffer_handler = logging.handlers.MemoryHandler(
+            capacity, flushLevel=logging.ERROR, target=self.file_handler
+        )
+        self.summary_handler = SummaryHandler()
+        self.listener = logging.handlers.QueueListener(
+            self.queue, self.buffer_handler, self.summary_handler
+        )
+
+    def start(self):
+        configure_worker(self.queue)
+        self.listener.start()
+
+    def stop(self):
+        self.listener.stop()
+        self.buffer_handler.close()
+        self.file_handler.close()
+        self.summary_handler.save(self.summary_filename)
+
+
+def configure_worker(queue):
+    """Send this process' events to `queue` (call on each worker process)"""
+
+    logger.handlers = [logging.handlers.QueueHandler(queue)]
+    logger.propagate = False
+    logger.setLevel(logging.WARNING)
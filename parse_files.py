@@ -1,31 +1,68 @@
 #!/usr/bin/env python3
+import csv
+import datetime
+import gzip
+import io
 import logging
 import os
 import re
-from collections import OrderedDict
+import sys
+import zipfile
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal, DecimalException
+from itertools import islice
 from pathlib import Path
 
+import lxml.etree
+import lxml.html
 import openpyxl
 import rows
 import scrapy
 import xlrd
 from cached_property import cached_property
-from rows.utils import load_schema, make_header, open_compressed, slug
+from rows.utils import load_schema, make_header, slug
 
+import logs
 import settings
 import utils
+from checkpoint import Checkpoint, ChunkedCSVWriter
+from delta import generate_deltas
+from layout import LAYOUT_PROBE_ROWS, probe_layout
+from store import PlanilhaStore, plan_run
+from validation import ANOMALY_FIELD_NAMES, SheetValidator
 
 
-# TODO: add option to pass custom logger to FileExtractor class
 for path in (settings.LOG_PATH, settings.OUTPUT_PATH):
     if not path.exists():
         path.mkdir()
-logging.basicConfig(
-    filename=settings.LOG_PATH / "parser.log",
-    filemode="w",
-    format="%(name)s - %(levelname)s - %(message)s",
-)
+# Files loaded in memory ahead of the parser (and threads reading them)
+READ_AHEAD_FILES = 8
+READ_AHEAD_WORKERS = 4
+# Default `contents` of `extract_file` (the file is read there)
+NOT_READ = object()
+# Avoid reading all columns/rows from ODS files (they can be repeated
+# thousands of times when blank)
+ODS_MAX_COLUMNS = 50
+ODS_MAX_EMPTY_ROWS = 100
+ODS_OFFICE_NS = "urn:oasis:names:tc:opendocument:xmlns:office:1.0"
+ODS_TABLE_NS = "urn:oasis:names:tc:opendocument:xmlns:table:1.0"
+ODS_TEXT_NS = "urn:oasis:names:tc:opendocument:xmlns:text:1.0"
+# Low-cardinality text fields
+INTERNED_FIELDS = {
+    "cargo",
+    "cargo_de_origem",
+    "lotacao",
+    "lotacao_de_origem",
+    "orgao_de_origem",
+    "situacao",
+}
+# Fields replaced by codes when using `DictionaryEncoder`
+DICTIONARY_FIELDS = [
+    "tribunal",
+    "mes_ano_de_referencia",
+    "data_de_publicacao",
+] + sorted(INTERNED_FIELDS)
 regexp_date = re.compile(r"[0-9]{4}-[0-9]{2}-[0-9]{2}")
 regexp_numbers = re.compile(r"[0-9]")
 regexp_parenthesis = re.compile("(\([^)]+\))")
@@ -33,7 +70,7 @@ regexp_parenthesis = re.compile("(\([^)]+\))")
 
 class CustomDecimalField(rows.fields.DecimalField):
     @classmethod
-    def deserialize(cls, value):
+    def deserialize(cls, value, field_name=None):
         if not value or str(value or "").strip() in ("R$ -", "R$-"):
             return None
         elif isinstance(value, str):  # When string, they use "," as separator
@@ -43,15 +80,62 @@ class CustomDecimalField(rows.fields.DecimalField):
         try:
             value = super().deserialize(value.strip())
         except ValueError:
-            logging.warning(f"Error converting {repr(value)} to decimal.")
+            logs.event(
+                logging.WARNING, "invalid_decimal", field=field_name, value=value
+            )
             return None
         else:
             return value
 
 
+class CentavosField(CustomDecimalField):
+    """Money as integer centavos (fixed-point mode, see `use_fixed_point`)
+
+    CNJ values never have more than 2 decimal places, so there's no need to
+    create `Decimal` objects while parsing.
+    """
+
+    scale = 100
+
+    @classmethod
+    def deserialize(cls, value, field_name=None):
+        if not value or str(value or "").strip() in ("R$ -", "R$-"):
+            return None
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            number = value
+        elif isinstance(value, str):  # When string, they use "," as separator
+            number = value.replace("???", "").replace(".", "").replace(",", ".")
+        else:  # Other types (like dates or booleans from formatted cells)
+            number = str(value)
+
+        try:
+            return int(round(float(number) * cls.scale))
+        except (TypeError, ValueError, OverflowError):
+            logs.event(
+                logging.WARNING, "invalid_decimal", field=field_name, value=value
+            )
+            return None
+
+
+def format_centavos(value):
+    """Convert integer centavos to text with 2 decimal places
+
+    >>> format_centavos(123456)
+    '1234.56'
+    >>> format_centavos(-5)
+    '-0.05'
+    """
+
+    if value is None:
+        return None
+    sign = "-" if value < 0 else ""
+    reais, centavos = divmod(abs(value), 100)
+    return f"{sign}{reais}.{centavos:02d}"
+
+
 class CPFField(rows.fields.TextField):
     @classmethod
-    def deserialize(cls, value):
+    def deserialize(cls, value, *args, **kwargs):
         # Usually string, but can be integer too
         cpf = "".join(regexp_numbers.findall(str(value or ""))).strip()
         if set(cpf) in ({"0"}, {"9"}) or len(cpf) < 4:
@@ -122,20 +206,6 @@ SHEET_INFO = OrderedDict(
 )
 
 
-def merge_header_lines(first, second):
-    result = []
-    for value1, value2 in zip(first, second):
-        if value1 is None and value2 is None:
-            result.append(None)
-        elif value1 is None:
-            result.append(value2)
-        elif value2 is None:
-            result.append(value1)
-        else:
-            result.append(f"{value1} {value2}")
-    return result
-
-
 def fix_header(sheet_name, header):
     name = sheet_name
     if "-" in name:
@@ -239,7 +309,7 @@ def make_row(fields, row_values):
     """
 
     row = {
-        field_name: field_type.deserialize(row_values[index])
+        field_name: field_type.deserialize(row_values[index], field_name=field_name)
         for index, (field_name, field_type) in enumerate(fields.items())
     }
     return row
@@ -255,12 +325,20 @@ def is_filled(row):
 
 
 class FileExtractor:
-    def read_data(self, *args, **kwargs):
-        raise NotImplementedError()
-
-    def __init__(self, filename, file_metadata=None):
+    def __init__(self, filename, file_metadata=None, sheets=None, contents=None):
         self.filename = Path(filename)
         self.file_metadata = file_metadata or {}
+        self.sheets = list(sheets or SHEET_INFO.keys())
+        # File already loaded in memory (see `read_ahead`), if any
+        self.contents = contents
+
+    @property
+    def source(self):
+        """File-like object (or filename) to read the workbook from"""
+
+        if self.contents is not None:
+            return io.BytesIO(self.contents)
+        return str(self.filename)
 
     @cached_property
     def relative_filename(self):
@@ -290,8 +368,12 @@ class FileExtractor:
         name_slug = slug(name)
         for sheet_name in self.sheet_names:
             if slug(sheet_name) == name_slug:
-                logging.info(
-                    f"Using {repr(sheet_name)} instead of {repr(name)} on {self.relative_filename}"
+                logs.event(
+                    logging.INFO,
+                    "sheet_renamed",
+                    file=self.relative_filename,
+                    sheet=name,
+                    value=sheet_name,
                 )
                 return sheet_name
 
@@ -299,7 +381,12 @@ class FileExtractor:
         try:
             new_name = self.sheet_names[list(SHEET_INFO.keys()).index(name)]
         except IndexError:
-            logging.error(f"Sheet {repr(name)} not found on {self.relative_filename}")
+            logs.event(
+                logging.ERROR,
+                "sheet_not_found",
+                file=self.relative_filename,
+                sheet=name,
+            )
             return None
 
         return new_name
@@ -307,36 +394,50 @@ class FileExtractor:
     def sheet_rows(self, name):
         raise NotImplementedError()
 
+    def read_rows(self, sheet_name, start_row, fields):
+        """Read data rows (as dicts) from `start_row` on"""
+
+        for values in islice(self.sheet_rows(sheet_name), start_row, None):
+            values = list(values) + [None] * (len(fields) - len(values))
+            yield make_row(fields, values)
+
+    @cached_property
+    def layout(self):
+        """Locate metadata block, header lines and data start of needed sheets
+
+        Usually only the first `LAYOUT_PROBE_ROWS` rows of each sheet are read
+        (see `probe_layout`), once.
+        "Contracheque" is always needed (see `general_metadata`).
+        """
+
+        result = {}
+        for name in SHEET_INFO.keys():
+            if name != "Contracheque" and name not in self.sheets:
+                continue
+            sheet_name = self.define_sheet_name(name)
+            if sheet_name is None:
+                result[name] = None
+                continue
+            result[name], full_scan = probe_layout(self.sheet_rows(name))
+            result[name]["sheet_name"] = sheet_name
+            if full_scan:
+                logs.event(
+                    logging.WARNING,
+                    "layout_full_scan",
+                    file=self.relative_filename,
+                    sheet=name,
+                    value=LAYOUT_PROBE_ROWS,
+                )
+        return result
+
     def metadata(self, sheet_name):
-        header, start_row = [], None
-        for index, row in enumerate(self.sheet_rows(sheet_name)):
-            if "CPF" in row or "Nome" in row:  # First header line
-                header.append(row)
-            elif len(header) == 1:
-                if (
-                    row[0] in (None, "")
-                    and set(type(value) for value in row).issubset({type(None), str})
-                    and any(
-                        "total" in (value or "").lower()
-                        or "outra" in (value or "").lower()
-                        for value in row
-                    )
-                ):
-                    # Second header line
-                    header.append(row)
-                    start_row = index + 1
-                else:
-                    # Data starts in this row
-                    start_row = index
-                break
-        if len(header) > 1:
-            header = merge_header_lines(*header)
-        else:
-            header = header[0]
+        layout = self.layout[sheet_name]
+        if layout["header"] is None:
+            raise ValueError(f"Header not found on {repr(sheet_name)}")
 
         return {
-            "fields": make_fields(sheet_name, fix_header(sheet_name, header)),
-            "start_row": start_row,
+            "fields": make_fields(sheet_name, fix_header(sheet_name, layout["header"])),
+            "start_row": layout["start_row"],
         }
 
     @cached_property
@@ -345,15 +446,15 @@ class FileExtractor:
 
         # First, build the dict
         meta = {}
-        for index, row in enumerate(self.sheet_rows("Contracheque")):
-            if "CPF" in row or "Nome" in row:
-                end_row = index - 1
-                break
-        sheet_name = self.define_sheet_name("Contracheque")
-        table = self.read_data(sheet_name=sheet_name, end_row=end_row)
-        for row in table:
-            values = list(row._asdict().values())
-            if "-" not in (values[0] or ""):
+        layout = self.layout["Contracheque"]
+        if layout is None or layout["header"] is None:
+            raise ValueError(f"Metadata not found on {self.relative_filename}")
+        # The first line of the metadata block is read as header by rows
+        for values in layout["metadata"][1:]:
+            values = [
+                value.strip() if isinstance(value, str) else value for value in values
+            ]
+            if "-" not in str(values[0] or ""):
                 non_empty_values = []
                 for value in values:
                     if value and value not in non_empty_values:
@@ -370,8 +471,13 @@ class FileExtractor:
             court = court_from_metadata
         else:
             # TODO: may not procceed
-            logging.warning(
-                f"orgao from metadata ({repr(court or None)}) different from file metadata ({repr(court_from_metadata)}) on {self.relative_filename}"
+            logs.event(
+                logging.WARNING,
+                "metadata_mismatch",
+                file=self.relative_filename,
+                field="orgao",
+                value=court or None,
+                expected=court_from_metadata,
             )
         # Using same court named from download page to maintain consistency
         # (court names from there are more correct in general and will make
@@ -400,17 +506,28 @@ class FileExtractor:
                 year = f"20{year}"
             meta["mes_ano_de_referencia"] = f"{year}-{int(month):02d}-01"
         else:
-            logging.error(
-                f"Can't parse mes_ano_de_referencia ({repr(reference_month)}) in {self.relative_filename}"
+            logs.event(
+                logging.ERROR,
+                "invalid_metadata",
+                file=self.relative_filename,
+                field="mes_ano_de_referencia",
+                value=reference_month,
             )
             meta["mes_ano_de_referencia"] = reference_from_metadata
         if meta["mes_ano_de_referencia"] != reference_from_metadata:
-            logging.warning(
-                f"mes_ano_de_referencia ({repr(reference_month)}) different from file metadata ({repr(reference_from_metadata)})"
+            logs.event(
+                logging.WARNING,
+                "metadata_mismatch",
+                file=self.relative_filename,
+                field="mes_ano_de_referencia",
+                value=reference_month,
+                expected=reference_from_metadata,
             )
 
         # Publication date
         publication_date = meta.get("data_de_publicacao", None)
+        if isinstance(publication_date, datetime.date):
+            publication_date = meta["data_de_publicacao"] = publication_date.isoformat()
         if isinstance(publication_date, str):
             if not regexp_date.match(publication_date):
                 if publication_date.count("/") == 2:
@@ -421,15 +538,23 @@ class FileExtractor:
                         "data_de_publicacao"
                     ] = f"{year}-{int(month):02d}-{int(day):02d}"
                 else:
-                    logging.error(
-                        f"Can't parse data_de_publicacao ({repr(publication_date)}) from {self.relative_filename}"
+                    logs.event(
+                        logging.ERROR,
+                        "invalid_metadata",
+                        file=self.relative_filename,
+                        field="data_de_publicacao",
+                        value=publication_date,
                     )
             else:
                 meta["data_de_publicacao"] = publication_date.split()[0]
         else:
             if publication_date is not None:
-                logging.error(
-                    f"Can't parse data_de_publicacao ({repr(publication_date)}) and it's not None from {self.relative_filename}"
+                logs.event(
+                    logging.ERROR,
+                    "invalid_metadata",
+                    file=self.relative_filename,
+                    field="data_de_publicacao",
+                    value=publication_date,
                 )
             meta["data_de_publicacao"] = None
         if "T" in str(meta["data_de_publicacao"] or ""):
@@ -442,31 +567,29 @@ class FileExtractor:
         for key in list(meta.keys()):
             if key not in ("data_de_publicacao", "tribunal", "mes_ano_de_referencia"):
                 del meta[key]
-                logging.warning(
-                    f"Ignoring invalid general_metadata key {repr(key)} from {self.relative_filename}"
+                logs.event(
+                    logging.WARNING,
+                    "ignored_metadata",
+                    file=self.relative_filename,
+                    field=key,
                 )
 
         return meta
 
     def data(self, sheet_name):
-        final_sheet_name = self.define_sheet_name(sheet_name)
-        if final_sheet_name is None:
+        """Yield (spreadsheet row number, row) for each filled data row"""
+
+        if self.layout[sheet_name] is None:
             return
         meta = self.metadata(sheet_name)
         start_row = meta.pop("start_row")
         fields = meta.pop("fields")
-        table = self.read_data(
-            sheet_name=final_sheet_name,
-            start_row=start_row,
-            end_column=len(fields) - 1,
-            fields=fields,
-        )
-        for row in table:
-            row = row._asdict()
+        data_rows = self.read_rows(sheet_name, start_row, fields)
+        for row_number, row in enumerate(data_rows, start=start_row + 1):
             if is_filled(row):
                 # TODO: if value is a discount, check if it's < 0 (convert if
                 # needed)
-                yield row
+                yield row_number, row
 
     def extract(self, sheet_name):
         # Generate base dict with all needed keys
@@ -476,33 +599,36 @@ class FileExtractor:
         metadata["mes_de_referencia"] = self.file_metadata["mes"]
         base_row.update(metadata)
 
-        for row in self.data(sheet_name):
+        # Metadata values are shared by all rows (`base_row.copy()`), but
+        # low-cardinality text would be a new string object for each cell
+        for row_number, row in self.data(sheet_name):
             new_row = base_row.copy()
             for key, value in row.items():
-                new_row[key] = value.strip() if isinstance(value, str) else value
-            yield new_row
+                if isinstance(value, str):
+                    value = value.strip()
+                    if key in INTERNED_FIELDS:
+                        value = sys.intern(value)
+                new_row[key] = value
+            yield row_number, new_row
 
 
 class XLSFileExtractor(FileExtractor):
-    def read_data(self, *args, **kwargs):
-        if kwargs["sheet_name"] is None:
-            return []
-        else:
-            kwargs["skip_header"] = False
-
-            if "end_column" not in kwargs:
-                # Avoid reading all columns (even if blank)
-                kwargs["end_column"] = 50
-
-        return rows.import_from_xls(self.filename, *args, **kwargs)
-
     @cached_property
     def workbook(self):
         try:
-            wb = xlrd.open_workbook(self.filename, logfile=open(os.devnull, mode="w"))
+            # Cell formats are needed to convert numbers (like `rows` does)
+            wb = xlrd.open_workbook(
+                str(self.filename),
+                file_contents=self.contents,
+                formatting_info=True,
+                logfile=open(os.devnull, mode="w"),
+            )
         except xlrd.XLRDError as exp:
-            logging.error(
-                f"Cannot load workbook ({repr(exp.args[0])}) on {self.relative_filename}"
+            logs.event(
+                logging.ERROR,
+                "invalid_workbook",
+                file=self.relative_filename,
+                value=exp.args[0],
             )
             return None
         else:
@@ -526,23 +652,9 @@ class XLSFileExtractor(FileExtractor):
 
 
 class XLSXFileExtractor(FileExtractor):
-    def read_data(self, *args, **kwargs):
-        if kwargs["sheet_name"] is None:
-            return []
-        else:
-            kwargs["skip_header"] = False
-
-            if "end_column" not in kwargs:
-                # Avoid reading all columns (even if blank)
-                kwargs["end_column"] = 50
-
-        return rows.import_from_xlsx(
-            self.filename, workbook_kwargs={"data_only": True}, *args, **kwargs
-        )
-
     @cached_property
     def workbook(self):
-        return openpyxl.load_workbook(self.filename, data_only=True, read_only=True)
+        return openpyxl.load_workbook(self.source, data_only=True, read_only=True)
 
     @cached_property
     def sheet_names(self):
@@ -558,68 +670,646 @@ class XLSXFileExtractor(FileExtractor):
             yield [rows.plugins.xlsx._cell_to_python(cell) for cell in row]
 
 
+class HTMLFileExtractor(FileExtractor):
+    """HTML tables (usually published with a `.xls` extension)
+
+    Each `<table>` is considered a sheet.
+    """
+
+    @cached_property
+    def workbook(self):
+        try:
+            tree = lxml.html.parse(self.source)
+        except (lxml.etree.LxmlError, ValueError) as exp:
+            logs.event(
+                logging.ERROR,
+                "invalid_workbook",
+                file=self.relative_filename,
+                value=str(exp),
+            )
+            return None
+        else:
+            return tree.xpath("//table[not(ancestor::table)]")
+
+    @cached_property
+    def sheet_names(self):
+        names = []
+        for index, table in enumerate(self.workbook, start=1):
+            caption = table.xpath("string(./caption)").strip()
+            names.append(caption or f"Tabela {index}")
+        return names
+
+    def sheet(self, name):
+        """Get the desired sheet, fixing the name if needed"""
+
+        return self.workbook[self.sheet_names.index(self.define_sheet_name(name))]
+
+    def sheet_rows(self, name):
+        for tr in self.sheet(name).xpath(".//tr"):
+            row = []
+            for cell in tr.xpath("./td|./th"):
+                value = cell.text_content().strip() or None
+                row.extend([value] * int(cell.get("colspan", 1) or 1))
+            yield row or [None]
+
+
+class ODSFileExtractor(FileExtractor):
+    @cached_property
+    def workbook(self):
+        try:
+            with zipfile.ZipFile(self.source) as archive:
+                with archive.open("content.xml") as fobj:
+                    tree = lxml.etree.parse(fobj)
+        except (KeyError, zipfile.BadZipFile, lxml.etree.LxmlError) as exp:
+            logs.event(
+                logging.ERROR,
+                "invalid_workbook",
+                file=self.relative_filename,
+                value=str(exp),
+            )
+            return None
+        else:
+            return tree.findall(f".//{{{ODS_TABLE_NS}}}table")
+
+    @cached_property
+    def sheet_names(self):
+        return [table.get(f"{{{ODS_TABLE_NS}}}name") for table in self.workbook]
+
+    def sheet(self, name):
+        """Get the desired sheet, fixing the name if needed"""
+
+        return self.workbook[self.sheet_names.index(self.define_sheet_name(name))]
+
+    def sheet_rows(self, name):
+        for tr in self.sheet(name).iter(f"{{{ODS_TABLE_NS}}}table-row"):
+            row = []
+            for cell in tr:
+                if not cell.tag.endswith("table-cell"):
+                    continue
+                repeat = int(cell.get(f"{{{ODS_TABLE_NS}}}number-columns-repeated", 1))
+                # Avoid reading all columns (even if blank)
+                repeat = min(repeat, ODS_MAX_COLUMNS - len(row))
+                row.extend([ods_cell_value(cell)] * repeat)
+                if len(row) >= ODS_MAX_COLUMNS:
+                    break
+            repeat = int(tr.get(f"{{{ODS_TABLE_NS}}}number-rows-repeated", 1))
+            if repeat > ODS_MAX_EMPTY_ROWS and not any(row):
+                break  # Blank rows until the end of the sheet
+            for _ in range(repeat):
+                yield list(row) or [None]
+
+
+def ods_cell_value(cell):
+    value_type = cell.get(f"{{{ODS_OFFICE_NS}}}value-type")
+    if value_type in ("float", "percentage", "currency"):
+        return float(cell.get(f"{{{ODS_OFFICE_NS}}}value"))
+    elif value_type == "date":
+        return cell.get(f"{{{ODS_OFFICE_NS}}}date-value")
+    elif value_type == "boolean":
+        return cell.get(f"{{{ODS_OFFICE_NS}}}boolean-value") == "true"
+    text = "\n".join(
+        "".join(paragraph.itertext()) for paragraph in cell.iter(f"{{{ODS_TEXT_NS}}}p")
+    )
+    return text or None
+
+
+def sniff_format(contents):
+    """Detect the real file format by its first bytes (not its extension)"""
+
+    head = contents[:1024]
+    if head.startswith(b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1"):  # OLE2
+        return "xls"
+    elif head.startswith(b"PK\x03\x04"):  # Zip
+        try:
+            with zipfile.ZipFile(io.BytesIO(contents)) as archive:
+                names = set(archive.namelist())
+                mimetype = (
+                    archive.read("mimetype").strip() if "mimetype" in names else b""
+                )
+        except zipfile.BadZipFile:
+            return None
+        if "xl/workbook.xml" in names:
+            return "xlsx"
+        elif mimetype == b"application/vnd.oasis.opendocument.spreadsheet":
+            return "ods"
+        return None
+
+    head = head.lstrip(b"\xef\xbb\xbf \t\r\n").lower()
+    if any(tag in head for tag in (b"<html", b"<table", b"<!doctype html")):
+        return "html"
+    return None
+
+
+EXTRACTORS = {
+    "html": HTMLFileExtractor,
+    "ods": ODSFileExtractor,
+    "xls": XLSFileExtractor,
+    "xlsx": XLSXFileExtractor,
+}
+VALIDATORS = {
+    sheet_name: SheetValidator(sheet_name, info["schema"])
+    for sheet_name, info in SHEET_INFO.items()
+}
+
+
+def use_fixed_point():
+    """Parse money as integer centavos (`CentavosField`) instead of `Decimal`
+
+    Must be called before the extraction starts (and before worker processes
+    are created). Values are converted to text only when written.
+    """
+
+    for sheet_name, info in SHEET_INFO.items():
+        schema = info["schema"]
+        for field_name, field_type in schema.items():
+            if type(field_type) is CustomDecimalField:
+                schema[field_name] = CentavosField()
+                schema[field_name].optional = field_type.optional
+        VALIDATORS[sheet_name] = SheetValidator(sheet_name, schema)
+
+
+def read_file(arquivo):
+    """Load a downloaded file in memory (`None`, logged, if it can't be read)
+
+    Errors are not raised, so a failed read doesn't stop `read_ahead` (and the
+    files after this one).
+    """
+
+    try:
+        return (settings.BASE_PATH / Path(arquivo)).read_bytes()
+    except FileNotFoundError:
+        logs.event(logging.WARNING, "file_not_found", file=arquivo)
+    except OSError as exception:
+        logs.event(logging.ERROR, "read_error", file=arquivo, value=repr(exception))
+    return None
+
+
+def read_ahead(arquivos, depth=READ_AHEAD_FILES, workers=READ_AHEAD_WORKERS):
+    """Yield each file's contents while the next `depth` ones are being read
+
+    Files are read by a pool of threads, so parsing doesn't wait on storage
+    (like a network-mounted `data/download`). Files which can't be read are
+    yielded as `None` (see `read_file`).
+    """
+
+    arquivos = iter(arquivos)
+    with ThreadPoolExecutor(workers) as executor:
+        pending = deque(
+            executor.submit(read_file, arquivo) for arquivo in islice(arquivos, depth)
+        )
+        while pending:
+            contents = pending.popleft().result()
+            for arquivo in islice(arquivos, 1):
+                pending.append(executor.submit(read_file, arquivo))
+            yield contents
+
+
+def extract_file(arquivo, ano, mes, tribunal, sheets=None, contents=NOT_READ):
+    """Extract and validate all (or only `sheets`) sheets from one downloaded file
+
+    Return a dict with each sheet's rows plus the anomalies found, or `None`
+    if the file can't be read. `contents` is the file already loaded by
+    `read_ahead` (`None` if it couldn't be read); if not given, the file is
+    read here. Can be run on worker processes.
+    """
+
+    filename = settings.BASE_PATH / Path(arquivo)
+    if contents is NOT_READ:
+        contents = read_file(arquivo)
+    if contents is None:  # Already logged by `read_file`
+        return None
+
+    extension = filename.name.split(".")[-1].lower()
+    file_format = sniff_format(contents)
+    if file_format is None:
+        logs.event(logging.ERROR, "unknown_format", file=arquivo, value=extension)
+        return None
+    elif file_format != extension:
+        logs.event(
+            logging.WARNING,
+            "wrong_extension",
+            file=arquivo,
+            value=extension,
+            expected=file_format,
+        )
+    metadata = {"ano": ano, "mes": mes, "tribunal": utils.fix_tribunal(tribunal)}
+    extractor = EXTRACTORS[file_format](
+        filename, metadata, sheets=sheets, contents=contents
+    )
+    if extractor.workbook is None:
+        return None
+
+    result = {"data": {}, "anomalies": []}
+    for sheet_name in extractor.sheets:
+        logs.set_context(file=arquivo, sheet=sheet_name)
+        try:
+            row_numbers, data = [], []
+            for row_number, row in extractor.extract(sheet_name):
+                row_numbers.append(row_number)
+                data.append(row)
+        except ValueError:
+            import traceback
+
+            message = traceback.format_exc().strip().splitlines()[-1]
+            logs.event(
+                logging.ERROR,
+                "sheet_error",
+                file=extractor.relative_filename,
+                sheet=sheet_name,
+                value=message,
+            )
+        else:
+            result["data"][sheet_name] = data
+            result["anomalies"].extend(
+                VALIDATORS[sheet_name](
+                    data,
+                    arquivo=arquivo,
+                    reference_month=f"{ano}-{mes:02d}-01",
+                    row_numbers=row_numbers,
+                )
+            )
+    return result
+
+
+class DictionaryEncoder:
+    """Replace repeated text values (`DICTIONARY_FIELDS`) by integer codes
+
+    Codes are shared by all sheets and each new one is written to a lookup
+    table (coluna, codigo, valor) committed together with the other outputs.
+    """
+
+    field_names = ["coluna", "codigo", "valor"]
+
+    def __init__(self, filename, resume_size=None):
+        self.codes = {field_name: {} for field_name in DICTIONARY_FIELDS}
+        self.writer = ChunkedCSVWriter(
+            filename, fieldnames=self.field_names, resume_size=resume_size
+        )
+        if resume_size is not None:  # Load codes already committed
+            with gzip.open(filename, mode="rt", encoding="utf-8", newline="") as fobj:
+                for row in csv.DictReader(fobj):
+                    self.codes[row["coluna"]][row["valor"]] = int(row["codigo"])
+
+    def encode(self, row):
+        for field_name in DICTIONARY_FIELDS:
+            value = row.get(field_name)
+            if value is None or value == "":
+                continue
+            codes = self.codes[field_name]
+            code = codes.get(value)
+            if code is None:
+                code = codes[value] = len(codes) + 1
+                self.writer.writerows(
+                    [{"coluna": field_name, "codigo": code, "valor": value}]
+                )
+            row[field_name] = code
+
+    def commit(self):
+        return self.writer.commit()
+
+    def close(self):
+        self.writer.close()
+
+
+class ParseOutput:
+    """Output files (one per sheet plus anomalies) committed file by file"""
+
+    def __init__(
+        self,
+        sizes=None,
+        resume=False,
+        store=None,
+        path=None,
+        sheets=None,
+        dictionary=False,
+    ):
+        sizes = sizes or {}
+        self.store = store
+        self.path = Path(path or settings.OUTPUT_PATH)
+        if not self.path.exists():
+            self.path.mkdir(parents=True)
+        self.checkpoint = Checkpoint(self.path / settings.CHECKPOINT_FILENAME.name)
+        self.checkpoint.open(resume=resume)
+        self.anomaly_filename = self.path / settings.ANOMALY_FILENAME.name
+        self.writers, self.centavos_fields = {}, {}
+        for sheet_name in sheets or SHEET_INFO.keys():
+            info = SHEET_INFO[sheet_name]
+            self.centavos_fields[sheet_name] = [
+                field_name
+                for field_name, field_type in info["schema"].items()
+                if isinstance(field_type, CentavosField)
+            ]
+            field_names = list(info["schema"].keys()) + [
+                "tribunal",
+                "mes_de_referencia",
+                "mes_ano_de_referencia",
+                "ano_de_referencia",
+                "data_de_publicacao",
+            ]
+            self.writers[sheet_name] = ChunkedCSVWriter(
+                self.path / info["output_filename"].name,
+                fieldnames=field_names,
+                resume_size=sizes.get(info["output_filename"].name),
+            )
+        self.anomaly_writer = ChunkedCSVWriter(
+            self.anomaly_filename,
+            fieldnames=ANOMALY_FIELD_NAMES,
+            resume_size=sizes.get(self.anomaly_filename.name),
+        )
+        self.encoder = None
+        dictionary_filename = self.path / settings.DICTIONARY_FILENAME.name
+        if dictionary:
+            self.encoder = DictionaryEncoder(
+                dictionary_filename,
+                resume_size=sizes.get(dictionary_filename.name),
+            )
+        elif not sizes and dictionary_filename.exists():
+            # Outputs of a previous run with codes, now rewritten without them
+            dictionary_filename.unlink()
+
+    def write(self, arquivo, result):
+        if result is None:
+            return
+
+        for sheet_name, data in result["data"].items():
+            centavos_fields = self.centavos_fields[sheet_name]
+            for row in data:
+                for field_name in centavos_fields:
+                    row[field_name] = format_centavos(row[field_name])
+                if self.encoder is not None:
+                    self.encoder.encode(row)
+            self.writers[sheet_name].writerows(data)
+        self.anomaly_writer.writerows(result["anomalies"])
+
+        # Commit all sheets' chunks for this file before recording it as done
+        output_sizes = {
+            SHEET_INFO[sheet_name]["output_filename"].name: writer.commit()
+            for sheet_name, writer in self.writers.items()
+        }
+        output_sizes[self.anomaly_filename.name] = self.anomaly_writer.commit()
+        if self.encoder is not None:
+            output_sizes[settings.DICTIONARY_FILENAME.name] = self.encoder.commit()
+        parseado_em = self.checkpoint.commit(arquivo, output_sizes)
+        if self.store is not None:
+            self.store.mark_parsed(arquivo, parseado_em)
+            self.store.commit()
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+        self.anomaly_writer.close()
+        if self.encoder is not None:
+            self.encoder.close()
+        self.checkpoint.close()
+
+
+def merge_output(filename, new_filename, key, keys=()):
+    """Replace rows of an output file by the ones from a partial output
+
+    Rows from `filename` whose `key(row)` is in `keys` or in the keys of
+    `new_filename`'s rows are replaced by `new_filename`'s rows. The result is
+    written to a temporary file which then replaces `filename`.
+    """
+
+    keys = set(keys)
+    with gzip.open(new_filename, mode="rt", encoding="utf-8", newline="") as fobj:
+        reader = csv.DictReader(fobj)
+        field_names = reader.fieldnames
+        for row in reader:
+            keys.add(key(row))
+
+    temp_filename = filename.with_name(filename.name + ".tmp")
+    with gzip.open(temp_filename, mode="wt", encoding="utf-8", newline="") as fobj:
+        writer = csv.DictWriter(fobj, fieldnames=field_names)
+        writer.writeheader()
+        if filename.exists():
+            with gzip.open(filename, mode="rt", encoding="utf-8", newline="") as old:
+                for row in csv.DictReader(old):
+                    if key(row) not in keys:
+                        writer.writerow(row)
+        with gzip.open(new_filename, mode="rt", encoding="utf-8", newline="") as new:
+            writer.writerows(csv.DictReader(new))
+    os.replace(temp_filename, filename)
+
+
+def merge_selection(path, files, sheets=None):
+    """Replace rows of the outputs by the ones parsed (selectively) into `path`
+
+    `files` are the (arquivo, ano, mes, tribunal) of the parsed files: rows of
+    their courts/months and anomalies of their sheets are replaced.
+    """
+
+    sheets = list(sheets or SHEET_INFO.keys())
+    keys = set(
+        (utils.fix_tribunal(tribunal), str(ano), str(mes))
+        for _, ano, mes, tribunal in files
+    )
+    for sheet_name in sheets:
+        filename = SHEET_INFO[sheet_name]["output_filename"]
+        merge_output(
+            filename,
+            path / filename.name,
+            key=lambda row: (
+                row["tribunal"],
+                row["ano_de_referencia"],
+                row["mes_de_referencia"],
+            ),
+            keys=keys,
+        )
+    merge_output(
+        settings.ANOMALY_FILENAME,
+        path / settings.ANOMALY_FILENAME.name,
+        key=lambda row: (row["arquivo"], row["planilha"]),
+        keys=[
+            (arquivo, sheet_name) for arquivo, *_ in files for sheet_name in sheets
+        ],
+    )
+
+
+def year_month(value):
+    """Convert "YYYY-MM" to a (year, month) tuple"""
+
+    year, month = value.split("-")
+    return int(year), int(month)
+
+
 if __name__ == "__main__":
     import argparse
-    import csv
+    import shutil
 
-    import rows
     from tqdm import tqdm
 
-    import settings
+    sheet_slugs = {
+        info["output_filename"].name.split(".")[0]: sheet_name
+        for sheet_name, info in SHEET_INFO.items()
+    }
 
     parser = argparse.ArgumentParser()
     parser.add_argument("--start_at")
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue from the last file committed by a previous run",
+    )
+    parser.add_argument(
+        "--new",
+        action="store_true",
+        help="Parse only files not parsed yet, appending to the current outputs",
+    )
+    parser.add_argument(
+        "--fixed-point",
+        action="store_true",
+        help="Represent money as integer centavos while parsing (faster)",
+    )
+    parser.add_argument(
+        "--dictionary",
+        action="store_true",
+        help=(
+            "Replace repeated text values by codes (lookup table saved to "
+            f"{settings.DICTIONARY_FILENAME.name})"
+        ),
+    )
+    parser.add_argument(
+        "--delta",
+        action="store_true",
+        help="Save the rows changed since the last run to data/output/delta",
+    )
+    parser.add_argument(
+        "--tribunal",
+        action="append",
+        help="Parse only courts with this text in their names (can be repeated)",
+    )
+    parser.add_argument(
+        "--start", type=year_month, help="First reference month to parse (YYYY-MM)"
+    )
+    parser.add_argument(
+        "--end", type=year_month, help="Last reference month to parse (YYYY-MM)"
+    )
+    parser.add_argument(
+        "--sheet",
+        action="append",
+        choices=list(sheet_slugs.keys()),
+        help="Parse only this sheet (can be repeated)",
+    )
     args = parser.parse_args()
-
-    extractors = {"xls": XLSFileExtractor, "xlsx": XLSXFileExtractor}
-    file_list = open_compressed(settings.OUTPUT_PATH / "planilha.csv.gz", mode="rb")
-    fobjs, writers = [], {}
-    for sheet_name, info in SHEET_INFO.items():
-        fobj = open_compressed(info["output_filename"], mode="w", encoding="utf-8")
-        field_names = list(SHEET_INFO[sheet_name]["schema"].keys()) + [
-            "tribunal",
-            "mes_de_referencia",
-            "mes_ano_de_referencia",
-            "ano_de_referencia",
-            "data_de_publicacao",
+    if args.fixed_point:
+        use_fixed_point()
+    if settings.PLANILHA_DB.exists():
+        planilha_store = PlanilhaStore()
+    else:  # Spider was run without the item pipeline
+        planilha_store = PlanilhaStore.from_csv(
+            settings.OUTPUT_PATH / "planilha.csv.gz"
+        )
+    # When selecting files or sheets (or replacing files downloaded again),
+    # results are written to a separated directory and then merged into the
+    # current outputs
+    file_list, selective, output_path, done, sizes = plan_run(
+        planilha_store,
+        new_only=args.new,
+        resume=args.resume,
+        tribunais=args.tribunal,
+        start=args.start,
+        end=args.end,
+        sheets=args.sheet,
+    )
+    if args.dictionary and selective:
+        parser.error(
+            "--dictionary can't be used with --tribunal/--start/--end/--sheet "
+            "or when --new finds files downloaded again"
+        )
+    if args.dictionary and args.delta:
+        # Codes depend on the order files are parsed, so they change between runs
+        parser.error("--dictionary can't be used with --delta")
+    if args.new and not selective:
+        # Append (as new gzip members) to the outputs of previous runs
+        for filename in settings.OUTPUT_PATH.glob("*.csv.gz"):
+            sizes.setdefault(filename.name, filename.stat().st_size)
+    # Outputs which have codes instead of text values can't get plain rows
+    # (and vice versa)
+    encoded = settings.DICTIONARY_FILENAME.exists()
+    if encoded and selective:
+        parser.error(
+            "current outputs are dictionary-encoded "
+            f"({settings.DICTIONARY_FILENAME.name} exists): run a full parse before "
+            "using --tribunal/--start/--end/--sheet or --new with files downloaded "
+            "again"
+        )
+    elif sizes and encoded != args.dictionary:
+        parser.error(
+            "current outputs are dictionary-encoded, use --dictionary to add to them"
+            if encoded
+            else "current outputs are not dictionary-encoded, can't add to them "
+            "using --dictionary"
+        )
+    sheets = None
+    if args.sheet:
+        sheets = [
+            sheet_slugs[sheet_slug]
+            for sheet_slug in sheet_slugs
+            if sheet_slug in args.sheet
         ]
-        writers[sheet_name] = csv.DictWriter(fobj, fieldnames=field_names)
-        writers[sheet_name].writeheader()
-        fobjs.append(fobj)
-
-    started = False if args.start_at is not None else True
-    for row in tqdm(rows.import_from_csv(file_list)):
-        filename = settings.BASE_PATH / Path(row.arquivo)
-        if args.start_at == str(filename.relative_to(settings.BASE_PATH)):
-            started = True
-        if not started:
-            continue
-        if not filename.exists():
-            logging.warning(f"File not found: {row.arquivo}")
-            continue
-
-        extension = filename.name.split(".")[-1].lower()
-        metadata = {
-            "ano": row.ano,
-            "mes": row.mes,
-            "tribunal": utils.fix_tribunal(row.tribunal),
-        }
-        extractor = extractors[extension](filename, metadata)
-        if extractor.workbook is None:
-            continue
-        for sheet_name in SHEET_INFO.keys():
-            writer = writers[sheet_name]
-            try:
-                data = list(extractor.extract(sheet_name))
-            except ValueError:
-                import traceback
-
-                message = traceback.format_exc().strip().splitlines()[-1]
-                logging.error(
-                    f"Exception when parsing sheet {repr(sheet_name)} from {extractor.relative_filename}: {message}"
-                )
-            else:
-                writer.writerows(data)
 
-    for fobj in fobjs:
-        fobj.close()
+    event_log = logs.EventLog(
+        settings.LOG_PATH / "parser.log", settings.LOG_PATH / "parser-summary.csv"
+    )
+    event_log.start()
+    try:
+        # Selected files are marked as parsed only after the merge
+        output = ParseOutput(
+            sizes,
+            resume=args.resume,
+            store=None if selective else planilha_store,
+            path=output_path,
+            sheets=sheets,
+            dictionary=args.dictionary,
+        )
+
+        started = False if args.start_at is not None else True
+        to_parse = []
+        for row in file_list:
+            if args.start_at == row.arquivo:
+                started = True
+            if started and row.arquivo not in done:
+                to_parse.append(row)
+
+        parsed = set(done)
+        contents = read_ahead(row.arquivo for row in to_parse)
+        for row in tqdm(to_parse):
+            result = extract_file(
+                row.arquivo,
+                row.ano,
+                row.mes,
+                row.tribunal,
+                sheets=sheets,
+                contents=next(contents),
+            )
+            output.write(row.arquivo, result)
+            if result is not None:
+                parsed.add(row.arquivo)
+
+        output.close()
+        if selective:
+            merge_selection(
+                output_path,
+                [
+                    (row.arquivo, row.ano, row.mes, row.tribunal)
+                    for row in file_list
+                    if row.arquivo in parsed
+                ],
+                sheets=output.writers.keys(),
+            )
+            shutil.rmtree(output_path)
+            # Output sizes recorded by an interrupted full run are not valid
+            # anymore (merged files are rewritten), so it can't be resumed
+            if settings.CHECKPOINT_FILENAME.exists():
+                settings.CHECKPOINT_FILENAME.unlink()
+            for arquivo in parsed:
+                planilha_store.mark_parsed(arquivo)
+        if args.delta:
+            filenames = [info["output_filename"] for info in SHEET_INFO.values()]
+            for name, counts in generate_deltas(filenames).items():
+                print(name, dict(counts))
+        planilha_store.close()
+    finally:
+        # Also on errors, when the log and summary are most needed
+        event_log.stop()
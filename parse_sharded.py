@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""Parse the files on several nodes using a shared work queue
+
+# On one node: split the file list into shards
+python parse_sharded.py coordinator --shard-size 50
+# On each node (with `data` on shared storage):
+python parse_sharded.py worker --processes 4
+# After all shards are done: generate the standard output files
+python parse_sharded.py merge
+"""
+
+import logging
+import multiprocessing
+import os
+import shutil
+import socket
+import time
+import traceback
+
+import logs
+import settings
+from checkpoint import Checkpoint, concatenate_chunked
+from parse_files import (
+    NOT_READ,
+    SHEET_INFO,
+    ParseOutput,
+    extract_file,
+    merge_selection,
+    read_ahead,
+    use_fixed_point,
+    year_month,
+)
+from store import PlanilhaStore
+from workqueue import WorkQueue
+
+
+def shard_path(shard_id, attempt):
+    return settings.SHARDS_PATH / f"{shard_id:05d}-{attempt}"
+
+
+def coordinator(shard_size, tribunais=None, start=None, end=None):
+    store = PlanilhaStore()
+    files = [
+        {
+            "arquivo": row.arquivo,
+            "ano": row.ano,
+            "mes": row.mes,
+            "tribunal": row.tribunal,
+        }
+        for row in store.files(tribunais=tribunais, start=start, end=end)
+    ]
+    store.close()
+    shards = [
+        files[index : index + shard_size] for index in range(0, len(files), shard_size)
+    ]
+
+    if settings.SHARDS_PATH.exists():
+        shutil.rmtree(settings.SHARDS_PATH)
+    settings.SHARDS_PATH.mkdir(parents=True)
+    queue = WorkQueue(settings.WORK_QUEUE_DB)
+    queue.create(shards, metadata={"tribunais": tribunais, "start": start, "end": end})
+    queue.close()
+    print(f"{len(files)} files split into {len(shards)} shards")
+
+
+def parse_shard(output, files, renew):
+    """Parse a shard's files, logging (and skipping) the ones which fail"""
+
+    contents = read_ahead(row["arquivo"] for row in files)
+    for row in files:
+        arquivo = row["arquivo"]
+        try:
+            file_contents = next(contents, NOT_READ)
+        except Exception as exception:
+            # The read-ahead stopped: this and the next files are read by
+            # `extract_file`, so none of them is skipped
+            logs.event(
+                logging.ERROR, "read_ahead_error", file=arquivo, value=repr(exception)
+            )
+            file_contents = NOT_READ
+        try:
+            result = extract_file(
+                arquivo,
+                row["ano"],
+                row["mes"],
+                row["tribunal"],
+                contents=file_contents,
+            )
+            output.write(arquivo, result)
+        except Exception as exception:
+            logs.event(logging.ERROR, "file_error", file=arquivo, value=repr(exception))
+        renew()
+
+
+def worker(worker_id, fixed_point=False, poll_interval=10):
+    """Claim and parse shards until there's nothing left to do"""
+
+    if fixed_point:
+        use_fixed_point()
+    event_log = logs.EventLog(
+        settings.LOG_PATH / f"parser-{worker_id}.log",
+        settings.LOG_PATH / f"parser-summary-{worker_id}.csv",
+    )
+    event_log.start()
+    queue = WorkQueue(settings.WORK_QUEUE_DB)
+    try:
+        while True:
+            shard = queue.claim(worker_id)
+            if shard is None:
+                if not queue.unfinished():
+                    break
+                # Other workers' shards may fail or have their leases expired
+                time.sleep(poll_interval)
+                continue
+
+            shard_id, attempt, files = shard
+            try:
+                output = ParseOutput(path=shard_path(shard_id, attempt))
+                parse_shard(
+                    output, files, renew=lambda: queue.renew(shard_id, worker_id)
+                )
+                output.close()
+            except Exception:  # Not related to a file (like no disk space)
+                message = traceback.format_exc().strip().splitlines()[-1]
+                logs.event(logging.ERROR, "shard_error", value=message)
+                queue.fail(shard_id, worker_id, message)
+            else:
+                queue.complete(shard_id, attempt, worker_id)
+    finally:
+        queue.close()
+        event_log.stop()
+
+
+def merge():
+    """Concatenate the shards' outputs (in order) into the standard files
+
+    If the queue was created with filters (`--tribunal`/`--start`/`--end`),
+    the concatenated rows replace only the ones of the same courts/months in
+    the current outputs. Files committed by the shards are then marked as
+    parsed in the store.
+    """
+
+    queue = WorkQueue(settings.WORK_QUEUE_DB)
+    counts, done, metadata = queue.counts(), queue.done(), queue.metadata()
+    queue.close()
+    if len(done) != sum(counts.values()):
+        raise RuntimeError(f"Not all shards are done: {counts}")
+    elif not done:
+        raise RuntimeError("No shards to merge")
+    selective = any(metadata.values())
+    if selective and settings.DICTIONARY_FILENAME.exists():
+        raise RuntimeError(
+            "Current outputs are dictionary-encoded, can't merge a filtered queue"
+        )
+
+    paths = [shard_path(shard_id, attempt) for shard_id, attempt in done]
+    entries = [
+        entry
+        for path in paths
+        for entry, _ in Checkpoint(path / settings.CHECKPOINT_FILENAME.name).entries()
+    ]
+    filenames = [info["output_filename"] for info in SHEET_INFO.values()]
+    filenames.append(settings.ANOMALY_FILENAME)
+    output_path = (
+        settings.SHARDS_PATH / "selecao" if selective else settings.OUTPUT_PATH
+    )
+    if not output_path.exists():
+        output_path.mkdir(parents=True)
+    for filename in filenames:
+        concatenate_chunked(
+            [path / filename.name for path in paths], output_path / filename.name
+        )
+
+    store = PlanilhaStore()
+    if selective:
+        parsed = set(entry["arquivo"] for entry in entries)
+        merge_selection(
+            output_path,
+            [
+                (row.arquivo, row.ano, row.mes, row.tribunal)
+                for row in store.files()
+                if row.arquivo in parsed
+            ],
+        )
+        shutil.rmtree(output_path)
+    elif settings.DICTIONARY_FILENAME.exists():
+        # Shards' outputs have text values, not dictionary codes
+        settings.DICTIONARY_FILENAME.unlink()
+    # Output sizes recorded by an interrupted `parse_files.py` run are not
+    # valid anymore, so it can't be resumed
+    if settings.CHECKPOINT_FILENAME.exists():
+        settings.CHECKPOINT_FILENAME.unlink()
+
+    for entry in entries:
+        store.mark_parsed(entry["arquivo"], entry["parseado_em"])
+    store.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    coordinator_parser = subparsers.add_parser("coordinator")
+    coordinator_parser.add_argument("--shard-size", type=int, default=50)
+    coordinator_parser.add_argument("--tribunal", action="append")
+    coordinator_parser.add_argument("--start", type=year_month)
+    coordinator_parser.add_argument("--end", type=year_month)
+
+    worker_parser = subparsers.add_parser("worker")
+    worker_parser.add_argument(
+        "--processes", type=int, default=1, help="Local worker processes to start"
+    )
+    worker_parser.add_argument("--fixed-point", action="store_true")
+
+    subparsers.add_parser("merge")
+    args = parser.parse_args()
+
+    if args.command == "coordinator":
+        coordinator(args.shard_size, args.tribunal, args.start, args.end)
+    elif args.command == "worker":
+        prefix = f"{socket.gethostname()}-{os.getpid()}"
+        processes = [
+            multiprocessing.Process(
+                target=worker, args=(f"{prefix}-{index}", args.fixed_point)
+            )
+            for index in range(args.processes)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+    elif args.command == "merge":
+        merge()
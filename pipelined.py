@@ -0,0 +1,100 @@
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+
+import logs
+import settings
+from parse_files import ParseOutput, extract_file, use_fixed_point
+from store import PlanilhaStore
+
+
+# Sent by `SalariosMagistradosSpider.save_file` with the file's metadata row
+# (`row`) and contents (`body`)
+file_saved = object()
+
+
+def init_worker(queue, fixed_point):
+    """Set up a worker process (settings are not inherited when spawned)"""
+
+    logs.configure_worker(queue)
+    if fixed_point:
+        use_fixed_point()
+
+
+class ParseWhileDownloading:
+    """Scrapy extension which parses each file as soon as it's downloaded
+
+    Files are parsed by a pool of worker processes while the next downloads
+    are in flight; results are written (and checkpointed) as they finish.
+    Enable with `-s PARSE_WHILE_DOWNLOADING=1` (and optionally
+    `-s PARSE_WORKERS=N` and `-s PARSE_FIXED_POINT=1`).
+    """
+
+    def __init__(self, workers, fixed_point=False):
+        if fixed_point:
+            use_fixed_point()
+        self.event_log = logs.EventLog(
+            settings.LOG_PATH / "parser.log", settings.LOG_PATH / "parser-summary.csv"
+        )
+        self.event_log.start()
+        self.executor = ProcessPoolExecutor(
+            workers,
+            initializer=init_worker,
+            initargs=(self.event_log.queue, fixed_point),
+        )
+        self.output = ParseOutput()
+        self.lock = threading.Lock()
+        self.parsed = []
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("PARSE_WHILE_DOWNLOADING"):
+            raise NotConfigured()
+        extension = cls(
+            crawler.settings.getint("PARSE_WORKERS", os.cpu_count()),
+            fixed_point=crawler.settings.getbool("PARSE_FIXED_POINT"),
+        )
+        crawler.signals.connect(extension.file_saved, signal=file_saved)
+        crawler.signals.connect(extension.engine_stopped, signal=signals.engine_stopped)
+        return extension
+
+    def file_saved(self, row):
+        arquivo = str(row["arquivo"])
+        future = self.executor.submit(
+            extract_file, arquivo, row["ano"], row["mes"], row["tribunal"]
+        )
+        future.add_done_callback(partial(self.write, arquivo))
+
+    def write(self, arquivo, future):
+        try:
+            result = future.result()
+        except Exception as exception:
+            logs.event(logging.ERROR, "file_error", file=arquivo, value=repr(exception))
+            return
+
+        with self.lock:
+            try:
+                self.output.write(arquivo, result)
+            except Exception as exception:
+                logs.event(
+                    logging.ERROR, "file_error", file=arquivo, value=repr(exception)
+                )
+                return
+            if result is not None:
+                self.parsed.append(arquivo)
+
+    def engine_stopped(self):
+        self.executor.shutdown(wait=True)
+        self.output.close()
+
+        # Item pipeline is closed at this point, so the store is not in use
+        store = PlanilhaStore()
+        for arquivo in self.parsed:
+            store.mark_parsed(arquivo)
+        store.close()
+        self.event_log.stop()
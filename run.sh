@@ -3,6 +3,12 @@
 set -e
 rm -rf data/output
 
-time scrapy runspider --loglevel=INFO -o data/output/planilha.csv download_files.py
-gzip data/output/planilha.csv
-time python parse_files.py
+if [ "$1" = "--pipelined" ]; then
+	# Parse files while the next ones are being downloaded
+	time scrapy runspider --loglevel=INFO -s PARSE_WHILE_DOWNLOADING=1 -o data/output/planilha.csv download_files.py
+	gzip data/output/planilha.csv
+else
+	time scrapy runspider --loglevel=INFO -o data/output/planilha.csv download_files.py
+	gzip data/output/planilha.csv
+	time python parse_files.py
+fi
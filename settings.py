@@ -6,3 +6,11 @@ DOWNLOAD_PATH = BASE_PATH / "data" / "download"
 OUTPUT_PATH = BASE_PATH / "data" / "output"
 SCHEMA_PATH = BASE_PATH / "schema"
 LOG_PATH = BASE_PATH / "data" / "log"
+CHECKPOINT_FILENAME = OUTPUT_PATH / "checkpoint.jsonl"
+PLANILHA_DB = OUTPUT_PATH / "planilha.sqlite"
+ANOMALY_FILENAME = OUTPUT_PATH / "anomalia.csv.gz"
+DICTIONARY_FILENAME = OUTPUT_PATH / "dicionario.csv.gz"
+SHARDS_PATH = OUTPUT_PATH / "shards"
+WORK_QUEUE_DB = OUTPUT_PATH / "fila.sqlite"
+DELTA_PATH = OUTPUT_PATH / "delta"
+DELTA_STATE_DB = OUTPUT_PATH / "estado.sqlite"
@@ -0,0 +1,247 @@
+import datetime
+import hashlib
+import sqlite3
+from collections import namedtuple
+from pathlib import Path
+
+import settings
+from checkpoint import Checkpoint
+
+
+# Content changed (maybe republished by CNJ) after being parsed
+CHANGED = "parseado_em IS NOT NULL AND parseado_em < baixado_em"
+FIELD_NAMES = [
+    "ano",
+    "mes",
+    "tribunal",
+    "arquivo",
+    "url",
+    "baixado_em",
+    "parseado_em",
+    "hash",
+]
+Planilha = namedtuple("Planilha", FIELD_NAMES)
+RunPlan = namedtuple("RunPlan", ["files", "selective", "path", "done", "sizes"])
+
+
+class PlanilhaStore:
+    """Typed and indexed SQLite table with the downloaded files' metadata"""
+
+    def __init__(self, filename=settings.PLANILHA_DB):
+        self.filename = Path(filename)
+        if not self.filename.parent.exists():
+            self.filename.parent.mkdir(parents=True)
+        self.connection = sqlite3.connect(str(self.filename))
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS planilha (
+                ano INTEGER NOT NULL,
+                mes INTEGER NOT NULL,
+                tribunal TEXT,
+                arquivo TEXT NOT NULL,
+                url TEXT NOT NULL,
+                baixado_em TEXT,
+                parseado_em TEXT,
+                hash TEXT,
+                UNIQUE (ano, mes, tribunal, url)
+            );
+            CREATE INDEX IF NOT EXISTS planilha_ano_mes ON planilha (ano, mes);
+            CREATE INDEX IF NOT EXISTS planilha_tribunal ON planilha (tribunal);
+            CREATE INDEX IF NOT EXISTS planilha_arquivo ON planilha (arquivo);
+            """
+        )
+        # Stores created before content hashes were recorded
+        columns = [
+            row[1] for row in self.connection.execute("PRAGMA table_info(planilha)")
+        ]
+        if "hash" not in columns:
+            self.connection.execute("ALTER TABLE planilha ADD COLUMN hash TEXT")
+        self.connection.row_factory = lambda cursor, row: Planilha(*row)
+
+    @classmethod
+    def from_csv(cls, csv_filename, filename=settings.PLANILHA_DB):
+        """Create the store from the spider's CSV output (`planilha.csv.gz`)"""
+
+        # Only needed here (the rest of the module doesn't depend on `rows`)
+        import rows
+        from rows.utils import open_compressed
+
+        store = cls(filename)
+        fobj = open_compressed(csv_filename, mode="rb")
+        for row in rows.import_from_csv(fobj):
+            store.insert(row._asdict())
+        store.commit()
+        return store
+
+    def insert(self, item):
+        """Insert a file listed by the spider (`baixado_em` is kept if known)
+
+        Every file is downloaded again by each spider run, so `baixado_em` is
+        only updated by `record_download` when the content changes.
+        """
+
+        baixado_em = item.get("baixado_em")
+        if isinstance(baixado_em, datetime.datetime):
+            baixado_em = baixado_em.isoformat()
+        self.connection.execute(
+            """
+            INSERT INTO planilha (ano, mes, tribunal, arquivo, url, baixado_em)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (ano, mes, tribunal, url) DO UPDATE SET
+                arquivo = excluded.arquivo
+            """,
+            (
+                int(item["ano"]),
+                int(item["mes"]),
+                item["tribunal"],
+                str(item["arquivo"]),
+                item["url"],
+                baixado_em,
+            ),
+        )
+
+    def record_download(self, arquivo, content_hash, baixado_em=None):
+        """Record a downloaded file's content hash
+
+        `baixado_em` is set to now (making the file `CHANGED` if it was parsed)
+        only if the hash differs from the previous download's. Files without
+        a hash recorded yet keep their `baixado_em`.
+        """
+
+        baixado_em = baixado_em or datetime.datetime.now().isoformat()
+        self.connection.execute(
+            """
+            UPDATE planilha SET
+                baixado_em = CASE WHEN hash IS NOT NULL AND hash != ?
+                    THEN ? ELSE baixado_em END,
+                hash = ?
+            WHERE arquivo = ?
+            """,
+            (content_hash, baixado_em, content_hash, str(arquivo)),
+        )
+
+    def mark_parsed(self, arquivo, parseado_em=None):
+        """Record when a file was parsed (never moving back in time)
+
+        Also used to replay the checkpoint journal, which may have entries not
+        recorded here if a run crashed right after committing the outputs.
+        """
+
+        parseado_em = parseado_em or datetime.datetime.now().isoformat()
+        self.connection.execute(
+            """
+            UPDATE planilha SET parseado_em = ?
+            WHERE arquivo = ? AND (parseado_em IS NULL OR parseado_em < ?)
+            """,
+            (parseado_em, str(arquivo), parseado_em),
+        )
+
+    def files(self, new_only=False, tribunais=None, start=None, end=None):
+        """Files to be parsed, in the same order they were downloaded
+
+        `tribunais` is a list of parts of court names (matched with `LIKE`) and
+        `start`/`end` are inclusive `(ano, mes)` tuples. `new_only` selects the
+        files never parsed plus all files of the courts/months which have a
+        file downloaded again after being parsed (their rows must be replaced
+        in the outputs, not appended).
+        """
+
+        conditions, parameters = [], []
+        if new_only:
+            conditions.append(
+                "(parseado_em IS NULL OR (ano, mes, tribunal) IN "
+                f"(SELECT ano, mes, tribunal FROM planilha WHERE {CHANGED}))"
+            )
+        if tribunais:
+            conditions.append(
+                "(" + " OR ".join("tribunal LIKE ?" for _ in tribunais) + ")"
+            )
+            parameters.extend(f"%{tribunal}%" for tribunal in tribunais)
+        if start is not None:
+            conditions.append("(ano, mes) >= (?, ?)")
+            parameters.extend(start)
+        if end is not None:
+            conditions.append("(ano, mes) <= (?, ?)")
+            parameters.extend(end)
+
+        query = "SELECT * FROM planilha"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY rowid"
+        return self.connection.execute(query, parameters).fetchall()
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+def plan_run(
+    store,
+    output_path=settings.OUTPUT_PATH,
+    new_only=False,
+    resume=False,
+    tribunais=None,
+    start=None,
+    end=None,
+    sheets=None,
+):
+    """Decide which files a `parse_files.py` run parses and where it writes them
+
+    Files committed by a run which crashed before updating the store are
+    marked as parsed first. The run is selective (written to `selecao` and
+    then merged into the outputs) when filtered or when `new_only` finds files
+    downloaded again; a resumed full run is not, so it skips the files already
+    committed to the outputs (`done`, with their `sizes`).
+    """
+
+    output_path = Path(output_path)
+    checkpoint = Checkpoint(output_path / settings.CHECKPOINT_FILENAME.name)
+    for entry, _ in checkpoint.entries():
+        if "parseado_em" in entry:
+            store.mark_parsed(entry["arquivo"], entry["parseado_em"])
+    store.commit()
+    files = store.files(new_only=new_only, tribunais=tribunais, start=start, end=end)
+
+    selective = any((tribunais, start, end, sheets)) or (
+        new_only and any(row.parseado_em is not None for row in files)
+    )
+    path = output_path / "selecao" if selective else output_path
+    done, sizes = set(), {}
+    if resume:
+        done, sizes = Checkpoint(path / settings.CHECKPOINT_FILENAME.name).load()
+    return RunPlan(files, selective, path, done, sizes)
+
+
+class PlanilhaPipeline:
+    """Scrapy item pipeline saving `SalariosMagistradosSpider` items to the store"""
+
+    commit_every = 100
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        # `pipelined` imports this module, so it's only imported here
+        import pipelined
+
+        pipeline = cls()
+        crawler.signals.connect(pipeline.file_saved, signal=pipelined.file_saved)
+        return pipeline
+
+    def open_spider(self, spider):
+        self.store = PlanilhaStore()
+        self.count = 0
+
+    def process_item(self, item, spider):
+        self.store.insert(item)
+        self.count += 1
+        if self.count % self.commit_every == 0:
+            self.store.commit()
+        return item
+
+    def file_saved(self, row, body):
+        self.store.record_download(row["arquivo"], hashlib.blake2b(body).hexdigest())
+
+    def close_spider(self, spider):
+        self.store.close()
@@ -0,0 +1,54 @@
+import csv
+import gzip
+
+from checkpoint import Checkpoint, ChunkedCSVWriter, concatenate_chunked
+
+
+def read_csv(filename):
+    with gzip.open(filename, mode="rt", encoding="utf-8", newline="") as fobj:
+        return list(csv.reader(fobj))
+
+
+def test_resume_drops_incomplete_line(tmp_path):
+    filename = tmp_path / "checkpoint.jsonl"
+    checkpoint = Checkpoint(filename)
+    checkpoint.open()
+    checkpoint.commit("a", {"out.csv.gz": 10})
+    checkpoint.close()
+    with open(filename, mode="a") as fobj:  # Crash while writing
+        fobj.write('{"arquivo": "x", "si')
+
+    checkpoint.open(resume=True)
+    checkpoint.commit("b", {"out.csv.gz": 20})
+    checkpoint.commit("c", {"out.csv.gz": 30})
+    checkpoint.close()
+    assert Checkpoint(filename).load() == ({"a", "b", "c"}, {"out.csv.gz": 30})
+
+
+def test_chunked_writer_resume_drops_uncommitted_rows(tmp_path):
+    filename = tmp_path / "out.csv.gz"
+    writer = ChunkedCSVWriter(filename, fieldnames=["a"])
+    writer.writerows([{"a": 1}])
+    size = writer.commit()
+    writer.writerows([{"a": 2}])
+    writer.close()
+
+    writer = ChunkedCSVWriter(filename, fieldnames=["a"], resume_size=size)
+    writer.writerows([{"a": 3}])
+    writer.close()
+    assert read_csv(filename) == [["a"], ["1"], ["3"]]
+
+
+def test_concatenate_chunked_keeps_only_first_header(tmp_path):
+    filenames = []
+    for index, values in enumerate([[1, 2], [], [3]]):
+        filename = tmp_path / f"shard-{index}.csv.gz"
+        writer = ChunkedCSVWriter(filename, fieldnames=["a"])
+        for value in values:  # One member per row
+            writer.writerows([{"a": value}])
+            writer.commit()
+        writer.close()
+        filenames.append(filename)
+
+    concatenate_chunked(filenames, tmp_path / "out.csv.gz")
+    assert read_csv(tmp_path / "out.csv.gz") == [["a"], ["1"], ["2"], ["3"]]
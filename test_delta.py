@@ -0,0 +1,102 @@
+import csv
+import gzip
+import sqlite3
+
+from delta import DELETE, INSERT, UPDATE, DeltaState, sheet_delta
+
+
+HEADER = ["cpf", "nome", "valor", "tribunal", "mes_de_referencia", "ano_de_referencia"]
+
+
+def write_output(filename, data):
+    with gzip.open(filename, mode="wt", encoding="utf-8", newline="") as fobj:
+        writer = csv.writer(fobj)
+        writer.writerow(HEADER)
+        writer.writerows(data)
+
+
+def run(tmp_path, state, data, name):
+    write_output(tmp_path / "contracheque.csv.gz", data)
+    delta_filename = tmp_path / f"delta-{name}.csv.gz"
+    hashes, counts = sheet_delta(
+        tmp_path / "contracheque.csv.gz", delta_filename, state.hashes("contracheque")
+    )
+    state.replace("contracheque", hashes.items())
+    return delta_filename, counts
+
+
+def test_changes_between_runs(tmp_path):
+    state = DeltaState(tmp_path / "estado.sqlite")
+    first = [
+        ["1", "A", "10", "T", "1", "2019"],
+        ["1", "A", "11", "T", "1", "2019"],
+        ["2", "B", "5", "T", "1", "2019"],
+    ]
+    delta_filename, counts = run(tmp_path, state, first, "1")
+    assert not delta_filename.exists()  # First run only saves the state
+
+    second = [
+        ["1", "A", "10", "T", "1", "2019"],
+        ["2", "B", "6", "T", "1", "2019"],
+        ["3", "C", "7", "T", "1", "2019"],
+    ]
+    delta_filename, counts = run(tmp_path, state, second, "2")
+    assert counts == {INSERT: 1, UPDATE: 1, DELETE: 1}
+    with gzip.open(delta_filename, mode="rt", encoding="utf-8") as fobj:
+        rows = list(csv.DictReader(fobj))
+    assert [(row["operacao"], row["nome"], row["ordem"]) for row in rows] == [
+        (UPDATE, "B", "1"),
+        (INSERT, "C", "1"),
+        (DELETE, "A", "2"),
+    ]
+    # Removed rows have only the key columns
+    assert rows[2] == {
+        "operacao": DELETE,
+        "chave": rows[2]["chave"],
+        "ordem": "2",
+        "cpf": "1",
+        "nome": "A",
+        "valor": "",
+        "tribunal": "T",
+        "mes_de_referencia": "1",
+        "ano_de_referencia": "2019",
+    }
+    state.close()
+
+
+def test_sheet_empty_on_previous_run(tmp_path):
+    state = DeltaState(tmp_path / "estado.sqlite")
+    run(tmp_path, state, [], "1")
+
+    delta_filename, counts = run(
+        tmp_path, state, [["1", "A", "10", "T", "1", "2019"]], "2"
+    )
+    assert counts == {INSERT: 1}
+    assert delta_filename.exists()
+    state.close()
+
+
+def test_state_saved_without_key_values(tmp_path):
+    connection = sqlite3.connect(str(tmp_path / "estado.sqlite"))
+    connection.executescript(
+        """
+        CREATE TABLE planilha (nome TEXT PRIMARY KEY, atualizada_em TEXT NOT NULL);
+        CREATE TABLE linha (
+            planilha TEXT NOT NULL,
+            chave BLOB NOT NULL,
+            hash BLOB NOT NULL,
+            PRIMARY KEY (planilha, chave)
+        ) WITHOUT ROWID;
+        INSERT INTO planilha VALUES ('contracheque', '2020-01-01T00:00:00');
+        INSERT INTO linha VALUES ('contracheque', X'01', X'02');
+        """
+    )
+    connection.close()
+
+    state = DeltaState(tmp_path / "estado.sqlite")
+    delta_filename, counts = run(tmp_path, state, [], "1")
+    assert counts == {DELETE: 1}
+    with gzip.open(delta_filename, mode="rt", encoding="utf-8") as fobj:
+        rows = list(csv.DictReader(fobj))
+    assert (rows[0]["chave"], rows[0]["ordem"], rows[0]["nome"]) == ("01", "", "")
+    state.close()
@@ -0,0 +1,86 @@
+from layout import find_layout, merge_header_lines, probe_layout
+
+
+METADATA = [
+    ["Tribunal de Justiça", None, None],
+    ["Órgão:", "TJAC", None],
+    ["Mês/Ano de Referência:", "01/2019", None],
+]
+HEADER = ["CPF", "Nome", "Subsídio"]
+DATA = [["12345678909", "Fulano", 1000.0], ["98765432100", "Beltrano", 2000.0]]
+
+
+def test_merge_header_lines():
+    first = ["CPF", "Nome", None, "Total"]
+    second = [None, None, "A", "B"]
+    assert merge_header_lines(first, second) == ["CPF", "Nome", "A", "Total B"]
+
+
+def test_one_line_header():
+    layout = find_layout(METADATA + [HEADER] + DATA)
+    assert layout == {"metadata": METADATA, "header": HEADER, "start_row": 4}
+
+
+def test_two_line_header():
+    first = ["CPF", "Nome", "Descontos", None]
+    second = [None, None, "Total de Descontos", "Outras Deduções"]
+    layout = find_layout(METADATA + [first, second] + DATA)
+    assert layout == {
+        "metadata": METADATA,
+        "header": ["CPF", "Nome", "Descontos Total de Descontos", "Outras Deduções"],
+        "start_row": 5,
+    }
+
+
+def test_numbers_are_not_a_second_header_line():
+    data = [[None, "Fulano", 1000.0, "total"]]
+    layout = find_layout([HEADER + ["Obs"]] + data)
+    assert layout["start_row"] == 1
+
+
+def test_header_not_found():
+    layout = find_layout(METADATA)
+    assert layout == {"metadata": METADATA, "header": None, "start_row": None}
+
+
+def test_header_on_last_row():
+    layout = find_layout(METADATA + [HEADER])
+    assert layout["header"] == HEADER
+    assert layout["start_row"] == 4
+
+
+def test_probe_reads_only_the_first_rows():
+    consumed = []
+
+    def sheet_rows():
+        for row in METADATA + [HEADER] + DATA * 100:
+            consumed.append(row)
+            yield row
+
+    layout, full_scan = probe_layout(sheet_rows(), probe_rows=10)
+    assert not full_scan
+    assert layout["start_row"] == 4
+    assert len(consumed) == 10
+
+
+def test_probe_falls_back_to_full_scan():
+    blank = [[None, None, None]] * 20
+    layout, full_scan = probe_layout(METADATA + blank + [HEADER] + DATA, 10)
+    assert full_scan
+    assert layout["header"] == HEADER
+    assert layout["start_row"] == 24
+
+
+def test_probe_header_on_last_probed_row():
+    second = [None, None, "Total"]
+    rows = METADATA + [["CPF", "Nome", "Subsídio"], second] + DATA
+    layout, full_scan = probe_layout(rows, probe_rows=4)
+    assert full_scan
+    assert layout["header"] == ["CPF", "Nome", "Subsídio Total"]
+    assert layout["start_row"] == 5
+
+
+def test_probe_short_sheet():
+    layout, full_scan = probe_layout(METADATA, probe_rows=10)
+    assert not full_scan
+    assert layout["header"] is None
@@ -0,0 +1,146 @@
+import sqlite3
+
+from checkpoint import Checkpoint
+from store import PlanilhaStore, plan_run
+
+
+def make_store(tmp_path, arquivos):
+    store = PlanilhaStore(tmp_path / "planilha.sqlite")
+    for index, arquivo in enumerate(arquivos):
+        store.insert(
+            {
+                "ano": 2019,
+                "mes": index + 1,
+                "tribunal": "Tribunal de Justiça do Acre",
+                "arquivo": arquivo,
+                "url": f"http://example.com/{arquivo}",
+                "baixado_em": "2020-01-01T00:00:00",
+            }
+        )
+    store.commit()
+    return store
+
+
+def crash_after(output_path, arquivos):
+    checkpoint = Checkpoint(output_path / "checkpoint.jsonl")
+    checkpoint.open()
+    for index, arquivo in enumerate(arquivos):
+        checkpoint.commit(arquivo, {"contracheque.csv.gz": (index + 1) * 10})
+    checkpoint.close()
+
+
+def test_resume_full_run_skips_committed_files(tmp_path):
+    store = make_store(tmp_path, ["a.xls", "b.xls", "c.xls"])
+    # The store may not have been updated before the crash
+    crash_after(tmp_path, ["a.xls", "b.xls"])
+
+    plan = plan_run(store, output_path=tmp_path, resume=True)
+    assert not plan.selective
+    assert plan.path == tmp_path
+    assert plan.done == {"a.xls", "b.xls"}
+    assert plan.sizes == {"contracheque.csv.gz": 20}
+    assert [row.arquivo for row in plan.files] == ["a.xls", "b.xls", "c.xls"]
+    # Replayed from the journal
+    parsed = [row.arquivo for row in store.files() if row.parseado_em is not None]
+    assert parsed == ["a.xls", "b.xls"]
+    store.close()
+
+
+def test_resume_new_run(tmp_path):
+    store = make_store(tmp_path, ["a.xls", "b.xls", "c.xls"])
+    store.mark_parsed("a.xls", "2020-01-02T00:00:00")
+    store.commit()
+    crash_after(tmp_path, ["b.xls"])
+
+    plan = plan_run(store, output_path=tmp_path, new_only=True, resume=True)
+    assert not plan.selective
+    assert [row.arquivo for row in plan.files] == ["c.xls"]
+    store.close()
+
+
+def test_filtered_run_is_selective(tmp_path):
+    store = make_store(tmp_path, ["a.xls", "b.xls"])
+    plan = plan_run(store, output_path=tmp_path, start=(2019, 2))
+    assert plan.selective
+    assert plan.path == tmp_path / "selecao"
+    assert [row.arquivo for row in plan.files] == ["b.xls"]
+    assert plan.done == set()
+    store.close()
+
+
+def test_new_only_files(tmp_path):
+    store = make_store(tmp_path, ["a.xls", "b.xls", "c.xls"])
+    store.insert(  # Another file for the same court/month as "a.xls"
+        {
+            "ano": 2019,
+            "mes": 1,
+            "tribunal": "Tribunal de Justiça do Acre",
+            "arquivo": "a2.xls",
+            "url": "http://example.com/a2.xls",
+            "baixado_em": "2020-01-01T00:00:00",
+        }
+    )
+    for arquivo in ("a.xls", "a2.xls", "b.xls", "c.xls"):
+        store.record_download(arquivo, f"hash-{arquivo}")
+    for arquivo in ("a.xls", "a2.xls", "b.xls"):
+        store.mark_parsed(arquivo, "2020-01-02T00:00:00")
+    store.commit()
+    assert [row.arquivo for row in store.files(new_only=True)] == ["c.xls"]
+
+    # All files are downloaded again by the spider, but only "a.xls" changed
+    store.insert(
+        {
+            "ano": 2019,
+            "mes": 1,
+            "tribunal": "Tribunal de Justiça do Acre",
+            "arquivo": "a.xls",
+            "url": "http://example.com/a.xls",
+            "baixado_em": "2020-01-03T00:00:00",
+        }
+    )
+    store.record_download("a.xls", "new-hash", "2020-01-03T00:00:00")
+    store.record_download("b.xls", "hash-b.xls", "2020-01-03T00:00:00")
+    store.commit()
+    files = store.files(new_only=True)
+    assert [row.arquivo for row in files] == ["a.xls", "c.xls", "a2.xls"]
+    assert files[0].baixado_em == "2020-01-03T00:00:00"
+    assert files[0].hash == "new-hash"
+    assert store.files(new_only=True, start=(2019, 2)) == files[1:2]
+    store.close()
+
+
+def test_first_hash_keeps_download_date(tmp_path):
+    store = make_store(tmp_path, ["a.xls"])
+    store.mark_parsed("a.xls", "2020-01-02T00:00:00")
+    store.record_download("a.xls", "hash", "2020-01-03T00:00:00")
+    store.commit()
+    assert store.files(new_only=True) == []
+    assert store.files()[0].baixado_em == "2020-01-01T00:00:00"
+    store.close()
+
+
+def test_adds_hash_to_old_stores(tmp_path):
+    connection = sqlite3.connect(str(tmp_path / "planilha.sqlite"))
+    connection.execute(
+        """
+        CREATE TABLE planilha (
+            ano INTEGER NOT NULL,
+            mes INTEGER NOT NULL,
+            tribunal TEXT,
+            arquivo TEXT NOT NULL,
+            url TEXT NOT NULL,
+            baixado_em TEXT,
+            parseado_em TEXT,
+            UNIQUE (ano, mes, tribunal, url)
+        )
+        """
+    )
+    connection.execute(
+        "INSERT INTO planilha VALUES (2019, 1, 'T', 'a.xls', 'u', '2020', NULL)"
+    )
+    connection.commit()
+    connection.close()
+
+    store = PlanilhaStore(tmp_path / "planilha.sqlite")
+    assert store.files()[0].hash is None
+    store.close()
@@ -0,0 +1,132 @@
+from decimal import Decimal
+
+import numpy as np
+
+from validation import (
+    SheetValidator,
+    check_cpf,
+    check_sum,
+    check_total_covers,
+    money_fields,
+)
+
+
+class TextField:
+    TYPE = (str,)
+
+
+class DecimalField:
+    TYPE = (Decimal,)
+
+
+class CentavosField(DecimalField):
+    scale = 100
+
+
+def columns(**values):
+    return {name: np.array(value, dtype=float) for name, value in values.items()}
+
+
+def test_check_cpf():
+    cpfs = np.array(
+        [
+            "529.982.247-25",  # Valid
+            "52998224725",  # Valid, without punctuation
+            "529.982.247-26",  # Wrong second digit
+            "529.982.247-15",  # Wrong first digit
+            "111.111.111-11",  # Valid digits, but all repeated
+            "***.982.247-**",  # Masked
+            "",
+        ]
+    )
+    assert check_cpf(cpfs).tolist() == [False, False, True, True, True, False, False]
+
+
+def test_check_cpf_without_complete_cpfs():
+    assert check_cpf(np.array(["***.982.247-**", ""])).tolist() == [False, False]
+
+
+def test_check_sum():
+    data = columns(total=[10, 10, np.nan, -7], a=[4, 4, 1, -3], b=[6, 5, 1, np.nan])
+    mask, difference = check_sum(data, total="total", components=["a", "b"])
+    assert mask.tolist() == [False, True, False, True]
+    assert difference[1] == 1
+
+    mask, _ = check_sum(data, total="total", components=["a", "b"], absolute=True)
+    assert mask.tolist() == [False, True, False, True]
+
+
+def test_check_sum_tolerance():
+    data = columns(total=[10.04, 10.06], a=[10, 10])
+    mask, _ = check_sum(data, total="total", components=["a"])
+    assert mask.tolist() == [False, True]
+
+
+def test_check_total_covers():
+    data = columns(total=[10, 12, 8, np.nan], a=[4, 4, 4, 4], b=[6, 6, 6, 6])
+    mask, difference = check_total_covers(data, total="total", components=["a", "b"])
+    assert mask.tolist() == [False, False, True, False]
+    assert difference[2] == -2
+
+
+def make_rows(*values):
+    return [
+        {
+            "cpf": "529.982.247-25",
+            "nome": f"Pessoa {index}",
+            "mes_ano_de_referencia": "2019-01-01",
+            "a": a,
+            "b": b,
+            "total": total,
+        }
+        for index, (a, b, total) in enumerate(values)
+    ]
+
+
+def test_money_fields():
+    schema = {"cpf": TextField(), "a": DecimalField(), "b": CentavosField()}
+    assert money_fields(schema) == ["a", "b"]
+
+
+def test_validator_row_numbers():
+    schema = {"cpf": TextField(), "nome": TextField()}
+    schema.update({name: DecimalField() for name in ("a", "b", "total")})
+    validator = SheetValidator("Indenizações", schema)
+    data = make_rows(
+        (Decimal("1"), Decimal("2"), Decimal("3")),
+        (Decimal("-1"), Decimal("2"), Decimal("1")),
+        (Decimal("1"), Decimal("2"), Decimal("2")),
+    )
+    data[2]["cpf"] = "529.982.247-26"
+
+    anomalies = validator(data, arquivo="a.xls", row_numbers=[10, 12, 15])
+    assert [(row["linha"], row["regra"]) for row in anomalies] == [
+        (12, "rendimento_negativo"),
+        (15, "total_menor_que_componentes"),
+        (15, "cpf_invalido"),
+    ]
+    # Without row numbers, the position in `data`
+    anomalies = validator(data, arquivo="a.xls")
+    assert [row["linha"] for row in anomalies] == [2, 3, 3]
+
+
+def test_validator_fixed_point():
+    schema = {"cpf": TextField(), "nome": TextField()}
+    schema.update({name: CentavosField() for name in ("a", "b", "total")})
+    validator = SheetValidator("Indenizações", schema)
+    assert validator.scale == 100
+
+    # 1.00 + 2.00 > 2.94 (difference above the tolerance), but not 2.96
+    data = make_rows((100, 200, 294), (100, 200, 296), (100, 200, None))
+    anomalies = validator(data, arquivo="a.xls", reference_month="2019-01-01")
+    assert [(row["linha"], row["valor"]) for row in anomalies] == [(1, "-0.06")]
+
+
+def test_validator_reference_month():
+    schema = {"cpf": TextField(), "nome": TextField(), "a": DecimalField()}
+    validator = SheetValidator("Indenizações", schema)
+    data = make_rows((1, None, None))
+    anomalies = validator(data, arquivo="a.xls", reference_month="2019-02-01")
+    assert [(row["regra"], row["valor"]) for row in anomalies] == [
+        ("mes_de_referencia_divergente", "2019-01-01")
+    ]
@@ -0,0 +1,88 @@
+import multiprocessing
+
+from workqueue import WorkQueue
+
+
+def claim_all(filename, worker, claimed):
+    queue = WorkQueue(filename)
+    while True:
+        shard = queue.claim(worker)
+        if shard is None:
+            break
+        shard_id, attempt, files = shard
+        claimed.put(shard_id)
+        queue.complete(shard_id, attempt, worker)
+    queue.close()
+
+
+def test_shards_are_claimed_once_by_concurrent_processes(tmp_path):
+    filename = tmp_path / "fila.sqlite"
+    queue = WorkQueue(filename)
+    queue.create([[{"arquivo": f"{index}.xls"}] for index in range(20)])
+
+    claimed = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=claim_all, args=(filename, f"w{index}", claimed))
+        for index in range(4)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    shard_ids = sorted(claimed.get() for _ in range(20))
+    assert shard_ids == list(range(20))
+    assert claimed.empty()
+    assert queue.counts() == {"done": 20}
+    assert queue.unfinished() == 0
+    queue.close()
+
+
+def test_expired_lease_is_claimed_again(tmp_path):
+    queue = WorkQueue(tmp_path / "fila.sqlite", lease_seconds=-1)
+    queue.create([[{"arquivo": "a.xls"}]])
+
+    assert queue.claim("w1") == (0, 1, [{"arquivo": "a.xls"}])
+    assert queue.claim("w2") == (0, 2, [{"arquivo": "a.xls"}])
+    # The first worker lost the lease, so its result is ignored
+    queue.complete(0, 1, "w1")
+    assert queue.done() == []
+    queue.complete(0, 2, "w2")
+    assert queue.done() == [(0, 2)]
+    queue.close()
+
+
+def test_renew_keeps_the_lease(tmp_path):
+    queue = WorkQueue(tmp_path / "fila.sqlite", lease_seconds=60)
+    queue.create([[{"arquivo": "a.xls"}]])
+
+    assert queue.claim("w1") is not None
+    queue.renew(0, "w1")
+    assert queue.claim("w2") is None
+    assert queue.unfinished() == 1
+    queue.close()
+
+
+def test_failed_shard_is_retried_until_max_attempts(tmp_path):
+    queue = WorkQueue(tmp_path / "fila.sqlite", max_attempts=2)
+    queue.create([[{"arquivo": "a.xls"}]])
+
+    shard_id, attempt, _ = queue.claim("w1")
+    queue.fail(shard_id, "w1", "error")
+    assert queue.counts() == {"pending": 1}
+    shard_id, attempt, _ = queue.claim("w2")
+    assert attempt == 2
+    queue.fail(shard_id, "w2", "error")
+    assert queue.counts() == {"failed": 1}
+    assert queue.claim("w3") is None
+    assert queue.unfinished() == 0
+    queue.close()
+
+
+def test_metadata_is_replaced_with_the_shards(tmp_path):
+    queue = WorkQueue(tmp_path / "fila.sqlite")
+    queue.create([[{"arquivo": "a.xls"}]], metadata={"start": (2019, 1), "end": None})
+    assert queue.metadata() == {"start": [2019, 1], "end": None}
+    queue.create([[{"arquivo": "a.xls"}]])
+    assert queue.metadata() == {}
+    queue.close()
@@ -0,0 +1,243 @@
+"""Consistency checks over whole columns of the extracted sheets
+
+Each rule receives the sheet's columns as numpy arrays (money as float64,
+`nan` for empty cells) and returns a boolean mask of the anomalous rows plus
+a value to report for them, so no rule iterates over rows in Python.
+"""
+from decimal import Decimal
+from functools import partial
+
+import numpy as np
+
+
+ANOMALY_FIELD_NAMES = ["arquivo", "planilha", "linha", "regra", "cpf", "nome", "valor"]
+# Differences up to a few centavos are rounding, not errors
+TOLERANCE = 0.05
+CPF_WEIGHTS_1 = np.arange(10, 1, -1)
+CPF_WEIGHTS_2 = np.arange(11, 1, -1)
+CONTRACHEQUE_RENDIMENTOS = [
+    "subsidio",
+    "direitos_pessoais",
+    "indenizacoes",
+    "direitos_eventuais",
+]
+CONTRACHEQUE_DESCONTOS = [
+    "descontos_previdencia_publica",
+    "imposto_de_renda",
+    "descontos_diversos",
+    "retencao_por_teto_constitucional",
+]
+
+
+def matrix(columns, names):
+    return np.vstack([columns[name] for name in names if name in columns])
+
+
+def check_sum(columns, total, components, absolute=False):
+    """Total must be equal to the sum of its components"""
+
+    values = matrix(columns, components)
+    if absolute:
+        values = np.abs(values)
+    expected = np.nansum(values, axis=0)
+    found = np.abs(columns[total]) if absolute else columns[total]
+    difference = found - expected
+    return ~np.isnan(found) & (np.abs(difference) > TOLERANCE), difference
+
+
+def check_total_covers(columns, total, components):
+    """Total can't be less than the sum of the (numeric) components
+
+    Sheets with "outra" columns have components which are not in the schema
+    as numbers, so only the lower bound can be checked.
+    """
+
+    expected = np.nansum(matrix(columns, components), axis=0)
+    difference = columns[total] - expected
+    return ~np.isnan(difference) & (difference < -TOLERANCE), difference
+
+
+def check_liquid(columns):
+    gross, discounts = columns["total_de_rendimentos"], columns["total_de_descontos"]
+    difference = columns["rendimento_liquido"] - (gross - np.abs(discounts))
+    return ~np.isnan(difference) & (np.abs(difference) > TOLERANCE), difference
+
+
+def check_non_negative(columns, names):
+    values = matrix(columns, names)
+    lowest = np.where(np.isnan(values), np.inf, values).min(axis=0)
+    return lowest < 0, lowest
+
+
+def check_same_sign(columns, names):
+    """Discounts must be all positive or all negative in the same row"""
+
+    values = matrix(columns, names)
+    mask = (values > 0).any(axis=0) & (values < 0).any(axis=0)
+    return mask, np.full(mask.shape, np.nan)
+
+
+def check_cpf(cpfs):
+    """Check verification digits of CPFs which have all the 11 digits
+
+    Masked/partial CPFs are not reported.
+    """
+
+    codes = cpfs.view(np.uint32).reshape(len(cpfs), -1)
+    is_digit = (codes >= ord("0")) & (codes <= ord("9"))
+    complete = is_digit.sum(axis=1) == 11
+    mask = np.zeros(len(cpfs), dtype=bool)
+    if not complete.any():
+        return mask
+    digits = (codes[complete][is_digit[complete]].reshape(-1, 11) - ord("0")).astype(
+        np.int64
+    )
+    digit_1 = (digits[:, :9] @ CPF_WEIGHTS_1 * 10 % 11) % 10
+    digit_2 = (digits[:, :10] @ CPF_WEIGHTS_2 * 10 % 11) % 10
+    invalid = (
+        (digit_1 != digits[:, 9])
+        | (digit_2 != digits[:, 10])
+        | (digits == digits[:, :1]).all(axis=1)
+    )
+    mask[complete] = invalid
+    return mask
+
+
+RULES = {
+    "Contracheque": [
+        (
+            "total_de_rendimentos_divergente",
+            partial(
+                check_sum,
+                total="total_de_rendimentos",
+                components=CONTRACHEQUE_RENDIMENTOS,
+            ),
+        ),
+        (
+            "total_de_descontos_divergente",
+            partial(
+                check_sum,
+                total="total_de_descontos",
+                components=CONTRACHEQUE_DESCONTOS,
+                absolute=True,
+            ),
+        ),
+        ("rendimento_liquido_divergente", check_liquid),
+        (
+            "sinal_de_desconto_inconsistente",
+            partial(check_same_sign, names=CONTRACHEQUE_DESCONTOS),
+        ),
+        (
+            "rendimento_negativo",
+            partial(
+                check_non_negative,
+                names=CONTRACHEQUE_RENDIMENTOS + ["total_de_rendimentos"],
+            ),
+        ),
+    ],
+}
+
+
+def money_fields(schema):
+    """Names of the decimal fields (`rows.fields.DecimalField` and subclasses)"""
+
+    return [
+        field_name
+        for field_name, field_type in schema.items()
+        if Decimal in getattr(field_type, "TYPE", ())
+    ]
+
+
+def sheet_rules(sheet_name, schema):
+    """Return the rules to be applied to a sheet given its schema"""
+
+    if sheet_name in RULES:
+        return RULES[sheet_name]
+
+    names = money_fields(schema)
+    if not names:
+        return []
+    components = [name for name in names if name != "total"]
+    rules = [("rendimento_negativo", partial(check_non_negative, names=names))]
+    if "total" in names:
+        rules.append(
+            (
+                "total_menor_que_componentes",
+                partial(check_total_covers, total="total", components=components),
+            )
+        )
+    return rules
+
+
+class SheetValidator:
+    """Apply all rules for one sheet to a batch of extracted rows"""
+
+    def __init__(self, sheet_name, schema):
+        self.sheet_name = sheet_name
+        self.fields = money_fields(schema)
+        # Money can be parsed as integer centavos (fixed-point mode)
+        self.scale = max(
+            [getattr(schema[name], "scale", 1) for name in self.fields] or [1]
+        )
+        self.rules = sheet_rules(sheet_name, schema)
+
+    def __call__(self, data, arquivo, reference_month=None, row_numbers=None):
+        """Return the anomalies found in `data` (one file's rows for the sheet)
+
+        `linha` is the row number in the spreadsheet (from `row_numbers`) or,
+        if not given, the row's position in `data` (starting at 1).
+        """
+
+        if not data:
+            return []
+
+        columns = {
+            field_name: np.array([row[field_name] for row in data], dtype=float)
+            / self.scale
+            for field_name in self.fields
+        }
+        results = [(name, *rule(columns)) for name, rule in self.rules]
+        cpfs = np.array([row["cpf"] or "" for row in data], dtype=str)
+        results.append(("cpf_invalido", check_cpf(cpfs), None))
+        anomalies = []
+        for rule_name, mask, values in results:
+            for index in np.flatnonzero(mask):
+                row = data[index]
+                value = None
+                if values is not None and not np.isnan(values[index]):
+                    value = f"{values[index]:.2f}"
+                anomalies.append(
+                    {
+                        "arquivo": arquivo,
+                        "planilha": self.sheet_name,
+                        "linha": (
+                            row_numbers[index]
+                            if row_numbers is not None
+                            else int(index) + 1
+                        ),
+                        "regra": rule_name,
+                        "cpf": row["cpf"],
+                        "nome": row["nome"],
+                        "valor": value,
+                    }
+                )
+
+        # All rows share the file's reference month, so report it once
+        if reference_month is not None:
+            months = np.array(
+                [row["mes_ano_de_referencia"] or "" for row in data], dtype=str
+            )
+            mismatch = np.flatnonzero(months != reference_month)
+            if len(mismatch):
+                anomalies.append(
+                    {
+                        "arquivo": arquivo,
+                        "planilha": self.sheet_name,
+                        "linha": None,
+                        "regra": "mes_de_referencia_divergente",
+                        "cpf": None,
+                        "nome": None,
+                        "valor": str(months[mismatch[0]]),
+                    }
+                )
+        return anomalies
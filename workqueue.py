@@ -0,0 +1,165 @@
+import json
+import sqlite3
+import time
+from pathlib import Path
+
+
+class WorkQueue:
+    """Durable queue of shards (lists of files) stored in a SQLite database
+
+    Workers claim a shard with a lease; if a worker dies, the lease expires
+    and the shard can be claimed again. Failed shards are retried up to
+    `max_attempts` times. The database must be on storage shared by all
+    workers (and the filesystem must support SQLite locking).
+    """
+
+    def __init__(self, filename, lease_seconds=600, max_attempts=3):
+        self.filename = Path(filename)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.connection = sqlite3.connect(
+            str(self.filename), timeout=60, isolation_level=None
+        )
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS shard (
+                id INTEGER PRIMARY KEY,
+                files TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                worker TEXT,
+                lease_until REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                done_attempt INTEGER,
+                error TEXT
+            );
+            CREATE INDEX IF NOT EXISTS shard_status ON shard (status);
+            CREATE TABLE IF NOT EXISTS metadata (
+                name TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            """
+        )
+
+    def create(self, shards, metadata=None):
+        """Replace the queue contents by `shards` (each one a list of dicts)
+
+        `metadata` is a dict (with JSON-serializable values) describing how
+        the shards were built, returned by `metadata()`.
+        """
+
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.connection.execute("DELETE FROM shard")
+            self.connection.executemany(
+                "INSERT INTO shard (id, files) VALUES (?, ?)",
+                [(index, json.dumps(files)) for index, files in enumerate(shards)],
+            )
+            self.connection.execute("DELETE FROM metadata")
+            self.connection.executemany(
+                "INSERT INTO metadata (name, value) VALUES (?, ?)",
+                [(name, json.dumps(value)) for name, value in (metadata or {}).items()],
+            )
+
+    def metadata(self):
+        return {
+            name: json.loads(value)
+            for name, value in self.connection.execute(
+                "SELECT name, value FROM metadata"
+            )
+        }
+
+    def claim(self, worker):
+        """Lease the next available shard
+
+        Return (id, attempt, files) or `None`. A shard can be processed more
+        than once (expired lease), so outputs must be separated by attempt.
+        """
+
+        now = time.time()
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            row = self.connection.execute(
+                """
+                SELECT id, attempts + 1, files FROM shard
+                WHERE
+                    (status = 'pending' OR (status = 'running' AND lease_until < ?))
+                    AND attempts < ?
+                ORDER BY id
+                LIMIT 1
+                """,
+                (now, self.max_attempts),
+            ).fetchone()
+            if row is None:
+                return None
+            self.connection.execute(
+                """
+                UPDATE shard
+                SET status = 'running', worker = ?, lease_until = ?,
+                    attempts = attempts + 1
+                WHERE id = ?
+                """,
+                (worker, now + self.lease_seconds, row[0]),
+            )
+        return row[0], row[1], json.loads(row[2])
+
+    def renew(self, shard_id, worker):
+        with self.connection:
+            self.connection.execute(
+                "UPDATE shard SET lease_until = ? WHERE id = ? AND worker = ?",
+                (time.time() + self.lease_seconds, shard_id, worker),
+            )
+
+    def complete(self, shard_id, attempt, worker):
+        with self.connection:
+            self.connection.execute(
+                """
+                UPDATE shard
+                SET status = 'done', lease_until = NULL, done_attempt = ?
+                WHERE id = ? AND worker = ? AND attempts = ?
+                """,
+                (attempt, shard_id, worker, attempt),
+            )
+
+    def fail(self, shard_id, worker, error):
+        with self.connection:
+            self.connection.execute(
+                """
+                UPDATE shard
+                SET status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END,
+                    lease_until = NULL, error = ?
+                WHERE id = ? AND worker = ?
+                """,
+                (self.max_attempts, error, shard_id, worker),
+            )
+
+    def counts(self):
+        """Number of shards by status"""
+
+        return dict(
+            self.connection.execute(
+                "SELECT status, COUNT(*) FROM shard GROUP BY status"
+            ).fetchall()
+        )
+
+    def unfinished(self):
+        """Number of shards which still can be (or are being) processed"""
+
+        return self.connection.execute(
+            """
+            SELECT COUNT(*) FROM shard
+            WHERE
+                (status = 'pending' AND attempts < ?)
+                OR (status = 'running' AND (lease_until >= ? OR attempts < ?))
+            """,
+            (self.max_attempts, time.time(), self.max_attempts),
+        ).fetchone()[0]
+
+    def done(self):
+        """(id, attempt) of the shards already processed"""
+
+        return self.connection.execute(
+            "SELECT id, done_attempt FROM shard WHERE status = 'done' ORDER BY id"
+        ).fetchall()
+
+    def close(self):
+        self.connection.close()